@@ -1,23 +1,46 @@
-import csv
-import os
-import tempfile
 import time
 from datetime import datetime as dt
+from urllib.parse import urlencode
 
 import dash
 import dash_bootstrap_components as dbc
 import dash_core_components as dcc
 import dash_html_components as html
 import dash_table
-import pandas as pd
 from dash.dependencies import Input, Output, State
-from flask import after_this_request, request, send_file
+from dash.exceptions import PreventUpdate
+from flask import Response, abort, jsonify, request
 from plotly import graph_objs as go
 
-from bart_ridership.db.data import BartRidershipData
-from bart_ridership.settings import MAPBOX_ACCESS_TOKEN, engine, log
+from bart_ridership.db.cache import QueryCache, get_cache_backend
+from bart_ridership.db.data import RIDERSHIP_COLUMNS, BartRidershipData
+from bart_ridership.db.stations import StationRegistry
+from bart_ridership.db.version import get_data_versions
+from bart_ridership.settings import (
+    MAPBOX_ACCESS_TOKEN,
+    QUERY_CACHE_BACKEND,
+    QUERY_CACHE_DIR,
+    QUERY_CACHE_MAX_ENTRIES,
+    QUERY_CACHE_REDIS_URL,
+    QUERY_CACHE_TTL,
+    dashboard_engine,
+)
 
-bart_ridership_data = BartRidershipData(connection=engine)
+query_cache = QueryCache(
+    backend=get_cache_backend(
+        QUERY_CACHE_BACKEND,
+        max_entries=QUERY_CACHE_MAX_ENTRIES,
+        ttl=QUERY_CACHE_TTL,
+        directory=QUERY_CACHE_DIR,
+        redis_url=QUERY_CACHE_REDIS_URL,
+    ),
+    # Station names and coordinates are baked into cached results and
+    # figures too, so a dim_station reload invalidates them as well
+    version_getter=lambda: get_data_versions(dashboard_engine),
+)
+bart_ridership_data = BartRidershipData(connection=dashboard_engine, cache=query_cache)
+station_registry = StationRegistry(dashboard_engine)
+PAGE_SIZE = 250
 default_columns = [
     "date",
     "hour",
@@ -42,8 +65,6 @@ app = dash.Dash(
 )
 app.title = "Bart Ridership Dashboard"
 
-mapbox_data = bart_ridership_data.get_station_lat_lon()
-
 body = dbc.Row(
     [
         dbc.Col(
@@ -117,196 +138,8 @@ body = dbc.Row(
                                     dcc.Dropdown(
                                         id="field-selection",
                                         options=[
-                                            {"label": "date", "value": "date"},
-                                            {"label": "epoch", "value": "epoch"},
-                                            {
-                                                "label": "day_suffix",
-                                                "value": "day_suffix",
-                                            },
-                                            {"label": "day_name", "value": "day_name"},
-                                            {
-                                                "label": "day_of_week",
-                                                "value": "day_of_week",
-                                            },
-                                            {
-                                                "label": "day_of_month",
-                                                "value": "day_of_month",
-                                            },
-                                            {
-                                                "label": "day_of_quarter",
-                                                "value": "day_of_quarter",
-                                            },
-                                            {
-                                                "label": "week_of_month",
-                                                "value": "week_of_month",
-                                            },
-                                            {
-                                                "label": "week_of_year",
-                                                "value": "week_of_year",
-                                            },
-                                            {
-                                                "label": "week_of_year_iso",
-                                                "value": "week_of_year_iso",
-                                            },
-                                            {
-                                                "label": "month_name",
-                                                "value": "month_name",
-                                            },
-                                            {
-                                                "label": "month_name_abbreviated",
-                                                "value": "month_name_abbreviated",
-                                            },
-                                            {
-                                                "label": "quarter_name",
-                                                "value": "quarter_name",
-                                            },
-                                            {"label": "mmyyyy", "value": "mmyyyy"},
-                                            {"label": "mmddyyyy", "value": "mmddyyyy"},
-                                            {
-                                                "label": "weekend_indr",
-                                                "value": "weekend_indr",
-                                            },
-                                            {"label": "hour", "value": "hour"},
-                                            {
-                                                "label": "trip_counter",
-                                                "value": "trip_counter",
-                                            },
-                                            {
-                                                "label": "origin_station",
-                                                "value": "origin_station",
-                                            },
-                                            {
-                                                "label": "destination_station",
-                                                "value": "destination_station",
-                                            },
-                                            {
-                                                "label": "origin_station_full_address",
-                                                "value": "origin_station_full_address",
-                                            },
-                                            {
-                                                "label": "destination_station_full_address",
-                                                "value": "destination_station_full_address",
-                                            },
-                                            {
-                                                "label": "destination_station_abbreviation",
-                                                "value": "destination_station_abbreviation",
-                                            },
-                                            {
-                                                "label": "origin_station_abbreviation",
-                                                "value": "origin_station_abbreviation",
-                                            },
-                                            {
-                                                "label": "origin_station_abbreviation",
-                                                "value": "origin_station_abbreviation_lower",
-                                            },
-                                            {
-                                                "label": "destination_station_abbreviation_lower",
-                                                "value": "destination_station_abbreviation_lower",
-                                            },
-                                            {
-                                                "label": "origin_station_city",
-                                                "value": "origin_station_city",
-                                            },
-                                            {
-                                                "label": "destination_station_city",
-                                                "value": "destination_station_city",
-                                            },
-                                            {
-                                                "label": "origin_station_cross_street",
-                                                "value": "origin_station_cross_street",
-                                            },
-                                            {
-                                                "label": "destination_station_cross_street",
-                                                "value": "destination_station_cross_street",
-                                            },
-                                            {
-                                                "label": "origin_station_latitude",
-                                                "value": "origin_station_latitude",
-                                            },
-                                            {
-                                                "label": "destination_station_latitude",
-                                                "value": "destination_station_latitude",
-                                            },
-                                            {
-                                                "label": "origin_station_link",
-                                                "value": "origin_station_link",
-                                            },
-                                            {
-                                                "label": "destination_station_link",
-                                                "value": "destination_station_link",
-                                            },
-                                            {
-                                                "label": "origin_station_longitude",
-                                                "value": "origin_station_longitude",
-                                            },
-                                            {
-                                                "label": "destination_station_longitude",
-                                                "value": "destination_station_longitude",
-                                            },
-                                            {
-                                                "label": "origin_station_north_routes",
-                                                "value": "origin_station_north_routes",
-                                            },
-                                            {
-                                                "label": "destination_station_north_routes",
-                                                "value": "destination_station_north_routes",
-                                            },
-                                            {
-                                                "label": "origin_station_south_routes",
-                                                "value": "origin_station_south_routes",
-                                            },
-                                            {
-                                                "label": "destination_station_south_routes",
-                                                "value": "destination_station_south_routes",
-                                            },
-                                            {
-                                                "label": "origin_station_south_platforms",
-                                                "value": "origin_station_south_platforms",
-                                            },
-                                            {
-                                                "label": "destination_station_south_platforms",
-                                                "value": "destination_station_south_platforms",
-                                            },
-                                            {
-                                                "label": "origin_station_north_platforms",
-                                                "value": "origin_station_north_platforms",
-                                            },
-                                            {
-                                                "label": "destination_station_north_platforms",
-                                                "value": "destination_station_north_platforms",
-                                            },
-                                            {
-                                                "label": "origin_station_state",
-                                                "value": "origin_station_state",
-                                            },
-                                            {
-                                                "label": "destination_station_state",
-                                                "value": "destination_station_state",
-                                            },
-                                            {
-                                                "label": "origin_station_zipcode",
-                                                "value": "origin_station_zipcode",
-                                            },
-                                            {
-                                                "label": "destination_station_zipcode",
-                                                "value": "destination_station_zipcode",
-                                            },
-                                            {
-                                                "label": "origin_link",
-                                                "value": "origin_link",
-                                            },
-                                            {
-                                                "label": "destination_link",
-                                                "value": "destination_link",
-                                            },
-                                            {
-                                                "label": "origin_station_map_url",
-                                                "value": "origin_station_map_url",
-                                            },
-                                            {
-                                                "label": "destination_map_url",
-                                                "value": "destination_map_url",
-                                            },
+                                            {"label": column, "value": column}
+                                            for column in RIDERSHIP_COLUMNS
                                         ],
                                         multi=True,
                                         value=default_columns,
@@ -356,14 +189,17 @@ body = dbc.Row(
                             children=[
                                 dash_table.DataTable(
                                     id="data-table",
-                                    page_action="native",
-                                    filter_action="native",
+                                    page_action="custom",
+                                    page_current=0,
+                                    page_size=PAGE_SIZE,
+                                    filter_action="custom",
+                                    filter_query="",
                                     style_table={
                                         "overflowX": "auto",
                                         "overflowY": "auto",
                                         "height": "420px",
                                     },
-                                    sort_action="native",
+                                    sort_action="custom",
                                     sort_mode="multi",
                                     style_filter={"background-color": "#ffffff"},
                                     style_header={
@@ -386,7 +222,8 @@ body = dbc.Row(
                             ],
                             fullscreen=True,
                             style={"background-color": "#1e1e1e"},
-                        )
+                        ),
+                        html.P(id="data-table-row-count"),
                     ],
                 ),
                 dcc.Graph(id="histogram-ridership-by-hour-by-date"),
@@ -427,6 +264,14 @@ color_val = [
 
 
 def get_histogram_figure(date, click_data=None):
+    station_abb = None
+    if click_data is not None:
+        station_abb = click_data["points"][0]["text"].split(" - ")[0]
+    return build_histogram_figure(date, station_abb)
+
+
+@query_cache.memoize
+def build_histogram_figure(date, station_abb=None):
 
     layout = go.Layout(
         bargap=0.01,
@@ -447,14 +292,20 @@ def get_histogram_figure(date, click_data=None):
         ),
     )
 
-    if click_data is not None:
-        station_abb = click_data["points"][0]["text"].split(" - ")[0]
-        df = bart_ridership_data.get_ridership_by_hour_by_station_and_date(
-            date, station_abb
+    snapshot = bart_ridership_data.get_date_snapshot(date)
+    if station_abb is not None:
+        df = snapshot["ridership_by_hour_by_station"].get(
+            station_abb,
+            {
+                "hour": [],
+                "origin_ridership_total": [],
+                "destination_ridership_total": [],
+            },
+        )
+        max_y = max(
+            df["origin_ridership_total"] + df["destination_ridership_total"],
+            default=0,
         )
-        max_y_origin = df["origin_ridership_total"].max()
-        max_y_destination = df["destination_ridership_total"].max()
-        max_y = max_y_origin if max_y_origin > max_y_destination else max_y_destination
         data = [
             go.Bar(
                 x=df["hour"],
@@ -489,8 +340,8 @@ def get_histogram_figure(date, click_data=None):
             for xi, yi in zip(df["hour"], df[col])
         ]
     else:
-        df = bart_ridership_data.get_ridership_by_hour_by_date(date)
-        max_y = df["ridership_total"].max()
+        df = snapshot["ridership_by_hour"]
+        max_y = max(df["ridership_total"], default=0)
         data = [
             go.Bar(
                 x=df["hour"],
@@ -522,7 +373,7 @@ def get_histogram_figure(date, click_data=None):
     )
 
     figure = go.Figure(data=data, layout=layout)
-    return figure
+    return figure.to_dict()
 
 
 @app.callback(Output("hover-ts", "children"), [Input("mapbox", "clickData")])
@@ -553,11 +404,11 @@ def update_hourly_histogram_by_date(date, click_data, n_clicks_timestamp, hover_
     else:
         if click_data is not None:
             station_abb = click_data["points"][0]["text"].split(" - ")[0]
-            station_info = bart_ridership_data.get_station_info(station_abb)
-            station_map_url = station_info["station_map_url"][0]
-            station_link = station_info["link"][0]
-            station_full_address = station_info["full_address"][0]
-            station_name = station_info["name"][0]
+            station_info = station_registry.get(station_abb)
+            station_map_url = station_info["station_map_url"]
+            station_link = station_info["link"]
+            station_full_address = station_info["full_address"]
+            station_name = station_info["name"]
             station_display = f"{station_abb} ({station_name})"
             station_full_address_str = f"Station address: {station_full_address}"
             station_links_str = f"More info: [Station link]({station_link}) and [Map]({station_map_url})"
@@ -574,93 +425,158 @@ def update_hourly_histogram_by_date(date, click_data, n_clicks_timestamp, hover_
     output=[Output("mapbox", "figure")], inputs=[Input("date-picker", "date")]
 )
 def update_map(date):
-    df = bart_ridership_data.get_ridership_by_station_by_date(date)
-    return [
-        go.Figure(
-            data=[
-                go.Scattermapbox(
-                    lat=df["latitude"],
-                    lon=df["longitude"],
-                    mode="markers",
-                    marker=go.scattermapbox.Marker(size=6),
-                    text=[
-                        f"{abbreviation} - Origin: {origin_cnt}, Destination: {destination_cnt}"
-                        for abbreviation, origin_cnt, destination_cnt in zip(
-                            df["abbreviation"],
-                            df["origin_count"],
-                            df["destination_count"],
-                        )
-                    ],
-                    hoverinfo="lat+lon+text",
-                )
-            ],
-            layout=go.Layout(
-                autosize=True,
-                hovermode="closest",
-                margin=go.layout.Margin(l=0, r=0, t=0, b=0),  # noqa: E741
-                mapbox=go.layout.Mapbox(
-                    accesstoken=MAPBOX_ACCESS_TOKEN,
-                    bearing=0,
-                    style="dark",
-                    center=dict(lat=37.806022, lon=-122.1118),
-                    pitch=0,
-                    zoom=8.5,
-                ),
+    return [get_map_figure(date)]
+
+
+@query_cache.memoize
+def get_map_figure(date):
+    df = bart_ridership_data.get_date_snapshot(date)["ridership_by_station"]
+    return go.Figure(
+        data=[
+            go.Scattermapbox(
+                lat=df["latitude"],
+                lon=df["longitude"],
+                mode="markers",
+                marker=go.scattermapbox.Marker(size=6),
+                text=[
+                    f"{abbreviation} - Origin: {origin_cnt}, Destination: {destination_cnt}"
+                    for abbreviation, origin_cnt, destination_cnt in zip(
+                        df["abbreviation"],
+                        df["origin_count"],
+                        df["destination_count"],
+                    )
+                ],
+                hoverinfo="lat+lon+text",
+            )
+        ],
+        layout=go.Layout(
+            autosize=True,
+            hovermode="closest",
+            margin=go.layout.Margin(l=0, r=0, t=0, b=0),  # noqa: E741
+            mapbox=go.layout.Mapbox(
+                accesstoken=MAPBOX_ACCESS_TOKEN,
+                bearing=0,
+                style="dark",
+                center=dict(lat=37.806022, lon=-122.1118),
+                pitch=0,
+                zoom=8.5,
             ),
-        )
-    ]
+        ),
+    ).to_dict()
 
 
 @app.callback(Output("total-rides", "children"), [Input("date-picker", "date")])
 def update_total_rides_selection(date, click_data=None):
-    total_rides = bart_ridership_data.get_total_ride_count_by_day(date)["cnt"][0]
+    total_rides = bart_ridership_data.get_date_snapshot(date)["total_rides"]
     return f"Total rides on {date}: {total_rides}"
 
 
 @app.callback(
-    output=[Output("data-table", "data"), Output("data-table", "columns")],
-    inputs=[Input("run-query", "n_clicks"), Input("date-picker", "date")],
+    Output("data-table", "page_current"),
+    [
+        Input("date-picker", "date"),
+        Input("data-table", "sort_by"),
+        Input("data-table", "filter_query"),
+    ],
+)
+def reset_data_table_page(date, sort_by, filter_query):
+    # A new date, sort or filter starts over from the first page
+    return 0
+
+
+@app.callback(
+    output=[
+        Output("data-table", "data"),
+        Output("data-table", "columns"),
+        Output("data-table-row-count", "children"),
+    ],
+    inputs=[
+        Input("run-query", "n_clicks"),
+        Input("date-picker", "date"),
+        Input("data-table", "page_current"),
+        Input("data-table", "page_size"),
+        Input("data-table", "sort_by"),
+        Input("data-table", "filter_query"),
+    ],
     state=[State("field-selection", "value")],
 )
-def update_data_table(n_clicks, date, columns):
-    ridership_by_date_df = bart_ridership_data.get_ridership_data_by_date(date)
-    selected_cols_df = ridership_by_date_df[columns]
-    new_cols = [{"name": i, "id": i} for i in selected_cols_df.columns]
-    return selected_cols_df.to_dict("records"), new_cols
+def update_data_table(
+    n_clicks, date, page_current, page_size, sort_by, filter_query, columns
+):
+    # Paging, sorting and filtering all happen in the database, so only the
+    # visible page of the selected columns is sent to the browser.
+    if not any(column in RIDERSHIP_COLUMNS for column in columns or []):
+        return [], [], "No columns selected"
+    page_df, total_rows = bart_ridership_data.get_ridership_page(
+        date, columns, page_current or 0, page_size, sort_by, filter_query
+    )
+    new_cols = [{"name": i, "id": i} for i in page_df.columns]
+    first_row = (page_current or 0) * page_size + 1 if len(page_df) else 0
+    last_row = (page_current or 0) * page_size + len(page_df)
+    row_count = f"Showing rows {first_row}-{last_row} of {total_rows}"
+    return page_df.to_dict("records"), new_cols, row_count
 
 
 @app.callback(
-    output=Output("download-csv", "href"), inputs=[Input("data-table", "data")]
+    output=Output("download-csv", "href"),
+    inputs=[
+        Input("date-picker", "date"),
+        Input("data-table", "columns"),
+        Input("data-table", "sort_by"),
+        Input("data-table", "filter_query"),
+    ],
 )
-def update_link(value):
-    df = pd.DataFrame(value)
-    with tempfile.NamedTemporaryFile(delete=False) as f:
-        tmp_fn = f.name
-        df.to_csv(tmp_fn, quoting=csv.QUOTE_ALL, encoding="utf-8")
-    return f"/dash/downloadcsv?tmp_fn={tmp_fn}"
+def update_link(date, columns, sort_by, filter_query):
+    # The export is rebuilt from these parameters when the link is followed
+    if not columns:
+        raise PreventUpdate
+    query = {
+        "date": date,
+        "columns": ",".join(column["id"] for column in columns),
+        "sort": ",".join(
+            f"{sort['column_id']}:{sort['direction']}" for sort in sort_by or []
+        ),
+        "filter": filter_query or "",
+    }
+    return f"/dash/downloadcsv?{urlencode(query)}"
 
 
 @app.server.route("/dash/downloadcsv")
 def download_csv():
-    tmp_fn = request.args.get("tmp_fn")
-
-    @after_this_request
-    def remove_file(response):
-        try:
-            os.remove(tmp_fn)
-        except Exception as error:
-            log.warn(f"Ran into an issue removing the tmp file: {error}")
-        return response
-
-    current_time = dt.now().strftime("%Y-%m-%d-%H:%m:%S")
-
-    return send_file(
-        tmp_fn,
-        mimetype="text/csv",
-        attachment_filename=f"ridership_{current_time}.csv",
-        as_attachment=True,
+    date = request.args.get("date", "")
+    end_date = request.args.get("end_date", date)
+    columns = [
+        column for column in request.args.get("columns", "").split(",") if column
+    ]
+    sort_by = []
+    for sort in request.args.get("sort", "").split(","):
+        if sort:
+            column_id, _, direction = sort.partition(":")
+            sort_by.append({"column_id": column_id, "direction": direction or "asc"})
+    filter_query = request.args.get("filter", "")
+    compress = request.args.get("gzip") == "1"
+    try:
+        dt.strptime(date, "%Y-%m-%d")
+        dt.strptime(end_date, "%Y-%m-%d")
+        sql, params = bart_ridership_data.get_ridership_table_sql(
+            date, columns, sort_by, filter_query, end_date=end_date
+        )
+    except ValueError as error:
+        abort(400, str(error))
+
+    date_range = date if end_date == date else f"{date}_{end_date}"
+    file_name = f"ridership_{date_range}.csv" + (".gz" if compress else "")
+    return Response(
+        bart_ridership_data.iter_csv(sql, params, compress=compress),
+        mimetype="application/gzip" if compress else "text/csv",
+        headers={"Content-Disposition": f"attachment; filename={file_name}"},
     )
 
 
+@app.server.route("/dash/cache/stats")
+def cache_stats():
+    return jsonify(query_cache.stats())
+
+
 if __name__ == "__main__":
     app.run_server(debug=True)
@@ -4,4 +4,4 @@
 cron
 env > /etc/environment
 # Start webserver
-gunicorn --workers 3 --bind 0.0.0.0:8000 -m 000 bart_ridership.app.wsgi
+gunicorn --config bart_ridership/app/gunicorn.conf.py -m 000 bart_ridership.app.wsgi
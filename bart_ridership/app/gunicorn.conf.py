@@ -0,0 +1,12 @@
+bind = "0.0.0.0:8000"
+workers = 3
+
+
+def post_fork(server, worker):
+    # Connections opened in the master before forking, e.g. with preload_app,
+    # must never be shared between workers, so every worker starts with
+    # empty pools.
+    from bart_ridership.settings import dashboard_engine, engine
+
+    engine.dispose()
+    dashboard_engine.dispose()
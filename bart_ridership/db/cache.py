@@ -0,0 +1,376 @@
+import contextlib
+import fcntl
+import functools
+import hashlib
+import os
+import pickle
+import stat
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from bart_ridership.settings import log
+
+_MISSING = object()
+
+
+@contextlib.contextmanager
+def _no_lock():
+    yield
+
+
+class MemoryBackend:
+    # Size-bounded LRU store with a per-entry TTL, private to the process.
+    shared = False
+
+    def __init__(self, max_entries=512, ttl=3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                return _MISSING
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def lock(self, key):
+        # Private to the process, where QueryCache already serializes misses
+        return _no_lock()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {
+            "backend": "memory",
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "evictions": self.evictions,
+        }
+
+
+def _digest(key):
+    return hashlib.sha256(repr(key).encode()).hexdigest()
+
+
+def make_private_directory(directory):
+    # Creates directory readable and writable by its owner only, refusing one
+    # that belongs to another user or is a symlink. Returns whether it had to
+    # be made private, in which case others could have written to it.
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    st = os.lstat(directory)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid():
+        raise PermissionError(f"{directory} is not a directory owned by this user")
+    if st.st_mode & 0o077:
+        os.chmod(directory, 0o700)
+        return True
+    return False
+
+
+class FileBackend:
+    # Pickled entries in a directory, one file per key, so every gunicorn
+    # worker on the host shares one copy. Writes go through a temporary file
+    # and os.replace, so readers never see a partial entry. Expiry is based
+    # on the file's mtime, and the oldest files are evicted once there are
+    # more than max_entries of them.
+    #
+    # Entries are unpickled, so anyone able to write to the directory could
+    # run code in the app. The directory is kept private to the app's user,
+    # and the entries of one that was not are all dropped.
+    #
+    # lock(key) takes an flock on a lock file of the key's own, so workers
+    # missing the same key wait for the first to compute it. Distinct keys
+    # never share a lock file, as a cached call computing another one, like
+    # a figure reading the date snapshot, would otherwise wait on a lock it
+    # already holds. Lock files unused for longer than the ttl are evicted
+    # along with the entries.
+    shared = True
+
+    def __init__(self, directory, max_entries=512, ttl=3600, evict_every=32):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.evict_every = evict_every
+        self.evictions = 0
+        self._sets = 0
+        self.locks_directory = os.path.join(directory, "locks")
+        if make_private_directory(directory):
+            log.warning(f"{directory} was writable by others, clearing it.")
+            self.clear()
+        make_private_directory(self.locks_directory)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{_digest(key)}.pkl")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            if os.path.getmtime(path) + self.ttl <= time.time():
+                return _MISSING
+            with open(path, "rb") as f:
+                return pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return _MISSING
+
+    def set(self, key, value):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self._path(key))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        self._sets += 1
+        if self._sets % self.evict_every == 0:
+            self.evict()
+
+    @contextlib.contextmanager
+    def lock(self, key):
+        path = os.path.join(self.locks_directory, f"{_digest(key)}.lock")
+        with open(path, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                os.utime(path)
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _entry_paths(self):
+        with os.scandir(self.directory) as entries:
+            return [entry.path for entry in entries if entry.name.endswith(".pkl")]
+
+    def evict(self):
+        mtimes = []
+        for path in self._entry_paths():
+            try:
+                mtimes.append((os.path.getmtime(path), path))
+            except OSError:
+                continue
+        mtimes.sort()
+        expired_before = time.time() - self.ttl
+        excess = len(mtimes) - self.max_entries
+        for i, (mtime, path) in enumerate(mtimes):
+            if i >= excess and mtime > expired_before:
+                break
+            try:
+                os.remove(path)
+                self.evictions += 1
+            except OSError:
+                pass
+        # At worst, a lock file removed while a worker waits on it lets one
+        # more worker compute the same key
+        with os.scandir(self.locks_directory) as entries:
+            for entry in entries:
+                try:
+                    if entry.stat().st_mtime <= expired_before:
+                        os.remove(entry.path)
+                except OSError:
+                    pass
+
+    def clear(self):
+        for path in self._entry_paths():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def stats(self):
+        return {
+            "backend": "file",
+            "directory": self.directory,
+            "entries": len(self._entry_paths()),
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "evictions": self.evictions,
+        }
+
+
+class RedisBackend:
+    # Entries in Redis, shared by every worker that can reach it. Only get,
+    # set(..., ex=ttl) and delete are used, so anything exposing those, such
+    # as a dict-backed stand-in in tests, works as the client.
+    shared = True
+
+    def __init__(self, client, ttl=3600, prefix="bart-ridership:"):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + _digest(key))
+        if value is None:
+            return _MISSING
+        return pickle.loads(value)
+
+    def set(self, key, value):
+        self.client.set(
+            self.prefix + _digest(key),
+            pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL),
+            ex=self.ttl,
+        )
+
+    def lock(self, key):
+        # Workers missing the same key at once each compute it
+        return _no_lock()
+
+    def clear(self):
+        # Entries expire on their own and are versioned, see QueryCache
+        pass
+
+    def stats(self):
+        return {"backend": "redis", "ttl": self.ttl, "prefix": self.prefix}
+
+
+def get_cache_backend(name, max_entries=512, ttl=3600, directory=None, redis_url=None):
+    if name == "memory":
+        return MemoryBackend(max_entries=max_entries, ttl=ttl)
+    if name == "file":
+        directory = directory or os.path.join(
+            tempfile.gettempdir(), "bart-ridership-cache"
+        )
+        return FileBackend(directory, max_entries=max_entries, ttl=ttl)
+    if name == "redis":
+        import redis
+
+        return RedisBackend(redis.Redis.from_url(redis_url), ttl=ttl)
+    raise ValueError(f"Unknown cache backend: {name}")
+
+
+class QueryCache:
+    # Caches query results and rendered figures in a pluggable backend. Keys
+    # are stamped with the data version returned by version_getter, which is
+    # polled at most every version_check_interval seconds, so entries cached
+    # before the loader published new data are never served again, no matter
+    # which worker wrote them.
+
+    def __init__(self, backend=None, version_getter=None, version_check_interval=30):
+        self.backend = backend if backend is not None else MemoryBackend()
+        self.version_getter = version_getter
+        self.version_check_interval = version_check_interval
+        self.hits = 0
+        self.misses = 0
+        self._version = None
+        self._version_checked_at = None
+        self._key_locks = {}
+        self._key_locks_lock = threading.Lock()
+
+    def _check_version(self):
+        if self.version_getter is None:
+            return
+        now = time.monotonic()
+        if (
+            self._version_checked_at is not None
+            and now - self._version_checked_at < self.version_check_interval
+        ):
+            return
+        self._version_checked_at = now
+        try:
+            version = self.version_getter()
+        except Exception as error:
+            log.warning(f"Could not check the data version: {error}")
+            return
+        if version != self._version:
+            if self._version is not None:
+                log.info(f"Data version changed to {version}.")
+                # Entries of the old version can no longer be hit, so there
+                # is no point in a private backend holding on to them.
+                if not self.backend.shared:
+                    self.backend.clear()
+            self._version = version
+
+    def _get(self, versioned_key):
+        try:
+            return self.backend.get(versioned_key)
+        except Exception as error:
+            log.warning(f"Could not read from the cache: {error}")
+            return _MISSING
+
+    def get_or_compute(self, key, compute):
+        self._check_version()
+        versioned_key = (self._version, key)
+        value = self._get(versioned_key)
+        if value is not _MISSING:
+            self.hits += 1
+            return value
+        # Threads missing the same key at once, like the callbacks fired by
+        # one date-picker change, wait for the first to compute it rather
+        # than all running the same query. The backend's lock does the same
+        # across processes, where it can.
+        with self._key_locks_lock:
+            key_lock = self._key_locks.setdefault(versioned_key, threading.Lock())
+        try:
+            with key_lock, self.backend.lock(versioned_key):
+                value = self._get(versioned_key)
+                if value is not _MISSING:
+                    self.hits += 1
+                    return value
+                self.misses += 1
+                value = compute()
+                try:
+                    self.backend.set(versioned_key, value)
+                except Exception as error:
+                    log.warning(f"Could not write to the cache: {error}")
+                return value
+        finally:
+            with self._key_locks_lock:
+                self._key_locks.pop(versioned_key, None)
+
+    def memoize(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = (func.__name__, _freeze(args), _freeze(kwargs))
+            return self.get_or_compute(key, lambda: func(*args, **kwargs))
+
+        return wrapper
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        stats = {
+            "version": self._version,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else None,
+        }
+        stats.update(self.backend.stats())
+        return stats
+
+
+def _freeze(value):
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    if isinstance(value, dict):
+        return tuple(sorted((key, _freeze(item)) for key, item in value.items()))
+    return value
+
+
+def cached(method):
+    # Caches a BartRidershipData method in self.cache, keyed on the method
+    # name and its arguments. A no-op when the instance has no cache.
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.cache is None:
+            return method(self, *args, **kwargs)
+        key = (method.__name__, _freeze(args), _freeze(kwargs))
+        return self.cache.get_or_compute(key, lambda: method(self, *args, **kwargs))
+
+    return wrapper
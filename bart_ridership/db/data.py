@@ -1,151 +1,646 @@
-from sqlalchemy import engine
+import csv
+import io
+import zlib
+
+from sqlalchemy import engine, text
 import pandas as pd
 
+from bart_ridership.db.cache import QueryCache, cached
+from bart_ridership.db.od_matrix import decode_od_matrix, station_flows, top_od_pairs
+from bart_ridership.db.prepared import PreparedQuery
+from bart_ridership.db.stream import GZIP_WBITS
+from bart_ridership.db.table_query import (
+    build_order_by,
+    build_where,
+    parse_filter_query,
+)
 
-class BartRidershipData:
-    def __init__(self, connection: engine):
-        self.connection = connection
+# Every column the ridership table can show: (name, SQL expression, join it
+# needs). Only the joins needed by the requested columns end up in the query.
+RIDERSHIP_COLUMN_DEFINITIONS = [
+    ("date", "dd.date", "dd"),
+    ("epoch", "dd.epoch", "dd"),
+    ("day_suffix", "dd.day_suffix", "dd"),
+    ("day_name", "dd.day_name", "dd"),
+    ("day_of_week", "dd.day_of_week", "dd"),
+    ("day_of_month", "dd.day_of_month", "dd"),
+    ("day_of_quarter", "dd.day_of_quarter", "dd"),
+    ("week_of_month", "dd.week_of_month", "dd"),
+    ("week_of_year", "dd.week_of_year", "dd"),
+    ("week_of_year_iso", "dd.week_of_year_iso", "dd"),
+    ("month_name", "dd.month_name", "dd"),
+    ("month_name_abbreviated", "dd.month_name_abbreviated", "dd"),
+    ("quarter_name", "dd.quarter_name", "dd"),
+    ("mmyyyy", "dd.mmyyyy", "dd"),
+    ("mmddyyyy", "dd.mmddyyyy", "dd"),
+    ("weekend_indr", "dd.weekend_indr", "dd"),
+    ("hour", "fr.hour", None),
+    ("trip_counter", "fr.trip_counter", None),
+    ("origin_station", "origin.name", "origin"),
+    ("destination_station", "dest.name", "dest"),
+    ("origin_station_full_address", "origin.full_address", "origin"),
+    ("destination_station_full_address", "dest.full_address", "dest"),
+    ("destination_station_abbreviation", "dest.abbreviation", "dest"),
+    ("origin_station_abbreviation", "origin.abbreviation", "origin"),
+    ("destination_station_abbreviation_lower", "dest.abbreviation_lower", "dest"),
+    ("origin_station_abbreviation_lower", "origin.abbreviation_lower", "origin"),
+    ("origin_station_city", "origin.city", "origin"),
+    ("destination_station_city", "dest.city", "dest"),
+    ("origin_station_cross_street", "origin.cross_street", "origin"),
+    ("destination_station_cross_street", "dest.cross_street", "dest"),
+    ("origin_station_latitude", "origin.latitude", "origin"),
+    ("destination_station_latitude", "dest.latitude", "dest"),
+    ("origin_station_link", "origin.link", "origin"),
+    ("destination_station_link", "dest.link", "dest"),
+    ("origin_station_longitude", "origin.longitude", "origin"),
+    ("destination_station_longitude", "dest.longitude", "dest"),
+    ("origin_station_north_routes", "origin.north_routes", "origin"),
+    ("destination_station_north_routes", "dest.north_routes", "dest"),
+    ("origin_station_south_routes", "origin.south_routes", "origin"),
+    ("destination_station_south_routes", "dest.south_routes", "dest"),
+    ("origin_station_south_platforms", "origin.south_platforms", "origin"),
+    ("destination_station_south_platforms", "dest.south_platforms", "dest"),
+    ("origin_station_north_platforms", "origin.north_platforms", "origin"),
+    ("destination_station_north_platforms", "dest.north_platforms", "dest"),
+    ("origin_station_state", "origin.state", "origin"),
+    ("destination_station_state", "dest.state", "dest"),
+    ("origin_station_zipcode", "origin.zipcode", "origin"),
+    ("destination_station_zipcode", "dest.zipcode", "dest"),
+    ("origin_link", "origin.link", "origin"),
+    ("destination_link", "dest.link", "dest"),
+    ("origin_station_map_url", "origin.station_map_url", "origin"),
+    ("destination_map_url", "dest.station_map_url", "dest"),
+]
 
-    def sql_to_df(self, sql):
-        return pd.read_sql(sql, con=self.connection)
+RIDERSHIP_COLUMNS = [name for name, _, _ in RIDERSHIP_COLUMN_DEFINITIONS]
 
-    def get_ridership_data_by_date(self, date="2011-01-01"):
-        date_id = date.replace("-", "")
-        sql = f"""
-        SELECT
-            date,
-            epoch,
-            day_suffix,
-            day_name,
-            day_of_week,
-            day_of_month,
-            day_of_quarter,
-            week_of_month,
-            week_of_year,
-            week_of_year_iso,
-            month_name,
-            month_name_abbreviated,
-            quarter_name,
-            mmyyyy,
-            mmddyyyy,
-            weekend_indr,
-            hour,
-            trip_counter,
-            origin.name as origin_station,
-            dest.name as destination_station,
-            origin.full_address as origin_station_full_address,
-            dest.full_address as destination_station_full_address,
-            dest.abbreviation as destination_station_abbreviation,
-            origin.abbreviation as origin_station_abbreviation,
-            dest.abbreviation_lower as destination_station_abbreviation_lower,
-            origin.abbreviation_lower as origin_station_abbreviation_lower,
-            origin.city as origin_station_city,
-            dest.city as destination_station_city,
-            origin.cross_street as origin_station_cross_street,
-            dest.cross_street as destination_station_cross_street,
-            origin.cross_street as origin_station_latitude,
-            dest.cross_street as destination_station_latitude,
-            origin.cross_street as origin_station_link,
-            dest.cross_street as destination_station_link,
-            origin.cross_street as origin_station_longitude,
-            dest.cross_street as destination_station_longitude,
-            origin.cross_street as origin_station_north_routes,
-            dest.cross_street as destination_station_north_routes,
-            origin.cross_street as origin_station_south_routes,
-            dest.cross_street as destination_station_south_routes,
-            origin.cross_street as origin_station_south_platforms,
-            dest.cross_street as destination_station_south_platforms,
-            origin.cross_street as origin_station_north_platforms,
-            dest.cross_street as destination_station_north_platforms,
-            origin.cross_street as origin_station_state,
-            dest.cross_street as destination_station_state,
-            origin.cross_street as origin_station_zipcode,
-            dest.cross_street as destination_station_zipcode,
-            origin.link AS origin_link,
-            dest.link AS destination_link,
-            origin.station_map_url AS origin_station_map_url,
-            dest.station_map_url AS destination_map_url
-        FROM bart.fact_ridership_{date_id[0:4]} fr
+RIDERSHIP_JOINS = {
+    "dd": """
         JOIN bart.dim_date dd ON 1=1
-            AND fr.date_id = dd.date_id
+            AND fr.date_id = dd.date_id""",
+    "origin": """
         JOIN bart.dim_station origin ON 1=1
-            AND fr.origin_station_id = origin.id
-        JOIN bart.dim_station dest  ON 1=1
-            AND fr.destination_station_id = dest.id
-        WHERE fr.date_id = '{date_id}'
-        ORDER BY hour, origin_station, destination_station
-        """
-        return self.sql_to_df(sql)
+            AND fr.origin_station_id = origin.id""",
+    "dest": """
+        JOIN bart.dim_station dest ON 1=1
+            AND fr.destination_station_id = dest.id""",
+}
 
-    def get_station_lat_lon(self):
-        sql = f"""
+NUMERIC_RIDERSHIP_COLUMNS = [
+    "epoch",
+    "day_of_week",
+    "day_of_month",
+    "day_of_quarter",
+    "week_of_month",
+    "week_of_year",
+    "hour",
+    "trip_counter",
+]
+
+
+# How get_*_by_date_range methods bucket dates, None keeping one row per day
+DATE_RANGE_PERIODS = {
+    None: "dd.date",
+    "day": "dd.date",
+    "week": "CAST(DATE_TRUNC('week', dd.date) AS DATE)",
+    "month": "CAST(DATE_TRUNC('month', dd.date) AS DATE)",
+}
+
+
+# The dashboard's hot queries, prepared once per pooled connection
+STATION_LAT_LON = PreparedQuery(
+    "bart_station_lat_lon",
+    """
     SELECT
         latitude,
         longitude,
         abbreviation
     FROM bart.dim_station
-        """
-        return self.sql_to_df(sql)
-
-    def get_ridership_by_hour_by_station_and_date(self, date, station_abb):
-        date_id = date.replace("-", "")
-        sql = f"""
+    """,
+)
+RIDERSHIP_BY_HOUR_BY_STATION_AND_DATE = PreparedQuery(
+    "bart_ridership_by_hour_by_station_and_date",
+    """
     SELECT
         hour,
         origin_ridership_total,
         destination_ridership_total
     FROM bart.fact_ridership_by_hour_by_station_by_date
     WHERE 1=1
-        AND date_id = '{date_id}'
-        AND abbreviation = '{station_abb}'
-        """
-        return self.sql_to_df(sql)
-
-    def get_ridership_by_hour_by_date(self, date):
-        date_id = date.replace("-", "")
-        sql = f"""
+        AND date_id = $1
+        AND abbreviation = $2
+    ORDER BY hour
+    """,
+    ["INT", "TEXT"],
+)
+RIDERSHIP_BY_HOUR_BY_DATE = PreparedQuery(
+    "bart_ridership_by_hour_by_date",
+    """
     SELECT
         hour,
         ridership_total
     FROM bart.fact_ridership_count_by_hour_by_date
-    WHERE date_id = '{date_id}'
-    ORDER BY hour;
-        """
-        return self.sql_to_df(sql)
+    WHERE date_id = $1
+    ORDER BY hour
+    """,
+    ["INT"],
+)
+RIDERSHIP_BY_STATION_BY_DATE = PreparedQuery(
+    "bart_ridership_by_station_by_date",
+    """
+    SELECT
+        abbreviation,
+        latitude,
+        longitude,
+        origin_count,
+        destination_count
+    FROM bart.fact_ridership_by_station_by_date
+    WHERE date_id = $1
+    """,
+    ["INT"],
+)
+TOTAL_RIDE_COUNT_BY_DAY = PreparedQuery(
+    "bart_total_ride_count_by_day",
+    """
+    SELECT
+        cnt
+    FROM bart.fact_ridership_count_by_date
+    WHERE date_id = $1
+    """,
+    ["INT"],
+)
+STATION_INFO = PreparedQuery(
+    "bart_station_info",
+    """
+    SELECT
+        name,
+        full_address,
+        intro,
+        link,
+        station_map_url
+    FROM bart.dim_station
+    WHERE abbreviation = $1
+    """,
+    ["TEXT"],
+)
+# Every per-date aggregate the dashboard shows, in one round-trip. The
+# hourly and per-station aggregates come back as JSON objects of column
+# arrays, the same shape PreparedQuery.fetch_columns returns.
+DATE_SNAPSHOT = PreparedQuery(
+    "bart_date_snapshot",
+    """
+    SELECT
+        (
+            SELECT cnt
+            FROM bart.fact_ridership_count_by_date
+            WHERE date_id = $1
+        ) AS total_rides,
+        (
+            SELECT json_build_object(
+                'hour', COALESCE(json_agg(hour ORDER BY hour), '[]'),
+                'ridership_total',
+                COALESCE(json_agg(ridership_total ORDER BY hour), '[]')
+            )
+            FROM bart.fact_ridership_count_by_hour_by_date
+            WHERE date_id = $1
+        ) AS ridership_by_hour,
+        (
+            SELECT json_build_object(
+                'abbreviation',
+                COALESCE(json_agg(abbreviation ORDER BY abbreviation), '[]'),
+                'latitude',
+                COALESCE(json_agg(latitude ORDER BY abbreviation), '[]'),
+                'longitude',
+                COALESCE(json_agg(longitude ORDER BY abbreviation), '[]'),
+                'origin_count',
+                COALESCE(json_agg(origin_count ORDER BY abbreviation), '[]'),
+                'destination_count',
+                COALESCE(json_agg(destination_count ORDER BY abbreviation), '[]')
+            )
+            FROM bart.fact_ridership_by_station_by_date
+            WHERE date_id = $1
+        ) AS ridership_by_station,
+        (
+            SELECT COALESCE(json_object_agg(abbreviation, hours), '{}')
+            FROM (
+                SELECT
+                    abbreviation,
+                    json_build_object(
+                        'hour', json_agg(hour ORDER BY hour),
+                        'origin_ridership_total',
+                        json_agg(origin_ridership_total ORDER BY hour),
+                        'destination_ridership_total',
+                        json_agg(destination_ridership_total ORDER BY hour)
+                    ) AS hours
+                FROM bart.fact_ridership_by_hour_by_station_by_date
+                WHERE date_id = $1
+                GROUP BY abbreviation
+            ) station_hours
+        ) AS ridership_by_hour_by_station
+    """,
+    ["INT"],
+)
+OD_MATRIX = PreparedQuery(
+    "bart_od_matrix",
+    """
+    SELECT
+        station_count,
+        matrix
+    FROM bart.od_matrix
+    WHERE date_id = $1
+    """,
+    ["INT"],
+)
 
-    def get_ridership_by_station_by_date(self, date):
-        date_id = date.replace("-", "")
-        sql = f"""
+
+class BartRidershipData:
+    def __init__(self, connection: engine, cache: QueryCache = None):
+        self.connection = connection
+        self.cache = cache
+
+    def sql_to_df(self, sql, params=None):
+        if params is not None:
+            return pd.read_sql(text(sql), con=self.connection, params=params)
+        return pd.read_sql(sql, con=self.connection)
+
+    def get_ridership_data_by_date_sql(self, date, columns=None, end_date=None):
+        # Selects the given columns (all by default) of a date's ridership
+        # rows, or of every date up to end_date, joining only the dimensions
+        # those columns come from. The station ids are always included for a
+        # cheap default sort order.
+        columns = RIDERSHIP_COLUMNS if columns is None else columns
+        date_id = int(date.replace("-", ""))
+        end_date_id = date_id if end_date is None else int(end_date.replace("-", ""))
+        if date_id // 10000 == end_date_id // 10000:
+            fact_table = f"bart.fact_ridership_{date_id // 10000}"
+        else:
+            fact_table = "bart.fact_ridership"
+        select = [
+            "fr.origin_station_id AS origin_station_id",
+            "fr.destination_station_id AS destination_station_id",
+        ]
+        joins = []
+        for name, expression, join in RIDERSHIP_COLUMN_DEFINITIONS:
+            if name not in columns:
+                continue
+            select.append(f"{expression} AS {name}")
+            if join is not None and join not in joins:
+                joins.append(join)
+        select_sql = ",\n            ".join(select)
+        joins_sql = "".join(
+            RIDERSHIP_JOINS[join] for join in RIDERSHIP_JOINS if join in joins
+        )
+        return f"""
         SELECT
-            abbreviation,
-            latitude,
-            longitude,
-            origin_count,
-            destination_count
-        FROM bart.fact_ridership_by_station_by_date
-        WHERE date_id = {date_id}
+            {select_sql}
+        FROM {fact_table} fr{joins_sql}
+        WHERE fr.date_id BETWEEN {date_id} AND {end_date_id}
         """
-        return self.sql_to_df(sql)
 
-    def get_total_ride_count_by_day(self, date):
-        date_id = date.replace("-", "")
+    def get_default_order_by(self, columns):
+        # Station names when they are selected anyway, otherwise station ids,
+        # which avoids joining dim_station just to sort
+        origin = (
+            "origin_station" if "origin_station" in columns else "origin_station_id"
+        )
+        destination = (
+            "destination_station"
+            if "destination_station" in columns
+            else "destination_station_id"
+        )
+        return ["hour", origin, destination]
+
+    @cached
+    def get_ridership_data_by_date(self, date="2011-01-01", columns=None):
+        columns = RIDERSHIP_COLUMNS if columns is None else columns
+        sql, params = self.get_ridership_table_sql(date, columns)
+        return self.sql_to_df(sql, params)
+
+    def get_ridership_table_sql(
+        self,
+        date,
+        columns,
+        sort_by=None,
+        filter_query="",
+        page_current=None,
+        page_size=None,
+        end_date=None,
+    ):
+        # Projects, filters and sorts the ridership rows of a date in SQL,
+        # with the DataTable's sort_by and filter_query translated into
+        # ORDER BY and WHERE clauses. Only the columns that are selected,
+        # filtered or sorted on are pulled from the fact and dimension
+        # tables. Given a page_size, only that page is selected, along with
+        # the total number of matching rows.
+        columns = [column for column in columns if column in RIDERSHIP_COLUMNS]
+        if not columns:
+            raise ValueError("No known columns selected")
+        conditions, params = build_where(
+            filter_query, RIDERSHIP_COLUMNS, NUMERIC_RIDERSHIP_COLUMNS
+        )
+        order_by = build_order_by(sort_by, RIDERSHIP_COLUMNS)
+        referenced = set(columns)
+        referenced.update(name for name, _, _ in parse_filter_query(filter_query))
+        referenced.update(sort["column_id"] for sort in sort_by or [])
+        if not order_by:
+            # The default order sorts on hour, so it is selected even when
+            # it is not displayed
+            referenced.add("hour")
+            order_by = self.get_default_order_by(referenced)
+
+        select = list(columns)
+        limit = ""
+        if page_size is not None:
+            select.append("COUNT(*) OVER () AS total_rows")
+            limit = "LIMIT :limit OFFSET :offset"
+            params.update(limit=page_size, offset=(page_current or 0) * page_size)
         sql = f"""
-        SELECT
-            cnt
-        FROM bart.fact_ridership_count_by_date
-        WHERE date_id = '{date_id}'
+        SELECT {", ".join(select)}
+        FROM ({self.get_ridership_data_by_date_sql(date, referenced, end_date)}) ridership
+        WHERE {" AND ".join(["1=1"] + conditions)}
+        ORDER BY {", ".join(order_by)}
+        {limit}
         """
-        return self.sql_to_df(sql)
+        return sql, params
 
+    @cached
+    def get_ridership_page(
+        self,
+        date,
+        columns,
+        page_current=0,
+        page_size=250,
+        sort_by=None,
+        filter_query="",
+    ):
+        # Returns one page of the ridership table and the total row count
+        sql, params = self.get_ridership_table_sql(
+            date, columns, sort_by, filter_query, page_current, page_size
+        )
+        df = self.sql_to_df(sql, params)
+        total_rows = int(df["total_rows"][0]) if len(df) else 0
+        if not len(df) and page_current:
+            # A page past the last matching row has no row to carry the
+            # count, so the matching rows are counted on their own
+            sql, params = self.get_ridership_table_sql(
+                date, columns, filter_query=filter_query
+            )
+            count_sql = f"SELECT COUNT(*) AS total_rows FROM ({sql}) matching"
+            total_rows = int(self.sql_to_df(count_sql, params)["total_rows"][0])
+        return df.drop(columns=["total_rows"]), total_rows
+
+    def iter_csv(self, sql, params=None, compress=False, fetch_size=10000):
+        # Streams the result of a query as CSV through a server-side cursor,
+        # fetch_size rows at a time, optionally gzip-compressed. Nothing but
+        # the current batch of rows is ever held in memory. Exports are exempt
+        # from the dashboard's statement timeout, as sorting a long date range
+        # before the first rows come back can take well over it.
+        compiled = text(sql).bindparams(**(params or {}))
+        compiled = compiled.compile(dialect=self.connection.dialect)
+        compressor = zlib.compressobj(wbits=GZIP_WBITS) if compress else None
+        conn = self.connection.raw_connection()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SET LOCAL statement_timeout = 0")
+            with conn.cursor(name="bart_ridership_csv_export") as cur:
+                cur.itersize = fetch_size
+                cur.execute(str(compiled), compiled.params)
+                buffer = io.StringIO()
+                writer = csv.writer(buffer, quoting=csv.QUOTE_ALL)
+                header_written = False
+                while True:
+                    rows = cur.fetchmany(fetch_size)
+                    if not header_written:
+                        writer.writerow([column[0] for column in cur.description])
+                        header_written = True
+                    writer.writerows(rows)
+                    chunk = buffer.getvalue().encode("utf-8")
+                    buffer.seek(0)
+                    buffer.truncate()
+                    if compressor is not None:
+                        chunk = compressor.compress(chunk)
+                    if chunk:
+                        yield chunk
+                    if not rows:
+                        break
+                if compressor is not None:
+                    yield compressor.flush()
+            conn.rollback()
+        finally:
+            conn.close()
+
+    @cached
+    def get_station_lat_lon(self):
+        return STATION_LAT_LON.to_df(self.connection)
+
+    @cached
+    def get_ridership_by_hour_by_station_and_date(self, date, station_abb):
+        return RIDERSHIP_BY_HOUR_BY_STATION_AND_DATE.to_df(
+            self.connection, int(date.replace("-", "")), station_abb
+        )
+
+    @cached
+    def get_ridership_by_hour_by_date(self, date):
+        return RIDERSHIP_BY_HOUR_BY_DATE.to_df(
+            self.connection, int(date.replace("-", ""))
+        )
+
+    @cached
+    def get_ridership_by_station_by_date(self, date):
+        return RIDERSHIP_BY_STATION_BY_DATE.to_df(
+            self.connection, int(date.replace("-", ""))
+        )
+
+    @cached
+    def get_total_ride_count_by_day(self, date):
+        return TOTAL_RIDE_COUNT_BY_DAY.to_df(
+            self.connection, int(date.replace("-", ""))
+        )
+
+    @cached
     def get_station_info(self, station_abb):
-        sql = f"""
+        return STATION_INFO.to_df(self.connection, station_abb)
+
+    # Lean variants of the methods above, which return a scalar, a row dict
+    # or a dict of column lists. The callbacks read the date snapshot instead,
+    # but these suit a single figure without the DataFrame overhead
+
+    @cached
+    def get_total_ride_count(self, date):
+        return TOTAL_RIDE_COUNT_BY_DAY.fetch_scalar(
+            self.connection, int(date.replace("-", ""))
+        )
+
+    @cached
+    def get_station_info_row(self, station_abb):
+        return STATION_INFO.fetch_row(self.connection, station_abb)
+
+    @cached
+    def get_ridership_by_hour_by_date_columns(self, date):
+        return RIDERSHIP_BY_HOUR_BY_DATE.fetch_columns(
+            self.connection, int(date.replace("-", ""))
+        )
+
+    @cached
+    def get_ridership_by_hour_by_station_and_date_columns(self, date, station_abb):
+        return RIDERSHIP_BY_HOUR_BY_STATION_AND_DATE.fetch_columns(
+            self.connection, int(date.replace("-", "")), station_abb
+        )
+
+    @cached
+    def get_ridership_by_station_by_date_columns(self, date):
+        return RIDERSHIP_BY_STATION_BY_DATE.fetch_columns(
+            self.connection, int(date.replace("-", ""))
+        )
+
+    @cached
+    def get_date_snapshot(self, date):
+        # A dict of the date's total_rides, ridership_by_hour,
+        # ridership_by_station and ridership_by_hour_by_station, the last
+        # keyed by station abbreviation, so the callbacks fired by one change
+        # of the date picker share a single query
+        return DATE_SNAPSHOT.fetch_row(self.connection, int(date.replace("-", "")))
+
+    @cached
+    def get_od_matrix(self, date):
+        # The day's (hour, origin, destination) trip counts, indexed by
+        # station id - 1, or None when the day has no matrix
+        _, rows = OD_MATRIX.execute(self.connection, int(date.replace("-", "")))
+        if not rows:
+            return None
+        station_count, matrix = rows[0]
+        return decode_od_matrix(matrix, station_count)
+
+    @cached
+    def get_od_matrix_stations(self):
+        # Station abbreviations by their index in the OD matrices
+        sql = "SELECT id, abbreviation FROM bart.dim_station"
+        abbreviations = dict(self.connection.execute(sql).fetchall())
+        if not abbreviations:
+            return []
+        return [abbreviations.get(i) for i in range(1, max(abbreviations) + 1)]
+
+    def get_od_matrix_by_hour(self, date, hour=None):
+        # The day's (origin, destination) matrix, for one hour or all of them
+        matrix = self.get_od_matrix(date)
+        if matrix is None:
+            return None
+        return matrix.sum(axis=0) if hour is None else matrix[hour]
+
+    def get_top_od_pairs(self, date, n=10, hour=None):
+        matrix = self.get_od_matrix_by_hour(date, hour)
+        stations = self.get_od_matrix_stations()
+        pairs = [] if matrix is None else top_od_pairs(matrix, n)
+        return pd.DataFrame(
+            [
+                (stations[origin], stations[destination], trips)
+                for origin, destination, trips in pairs
+                if trips
+            ],
+            columns=["origin", "destination", "trips"],
+        )
+
+    def get_station_flows(self, date, hour=None):
+        matrix = self.get_od_matrix_by_hour(date, hour)
+        stations = self.get_od_matrix_stations()
+        if matrix is None:
+            return pd.DataFrame(columns=["abbreviation", "origin", "destination"])
+        origin, destination = station_flows(matrix)
+        return pd.DataFrame(
+            {
+                "abbreviation": stations[: len(origin)],
+                "origin": origin,
+                "destination": destination,
+            }
+        ).dropna(subset=["abbreviation"])
+
+    def get_date_range_filter(self, start_date=None, end_date=None, dates=None):
+        # Either every date in [start_date, end_date] or the given dates
+        if dates is not None:
+            date_ids = [int(date.replace("-", "")) for date in dates]
+            return "v.date_id = ANY(:date_ids)", {"date_ids": date_ids}
+        if start_date is None or end_date is None:
+            raise ValueError("Either start_date and end_date or dates is required")
+        return (
+            "v.date_id BETWEEN :start_date_id AND :end_date_id",
+            {
+                "start_date_id": int(start_date.replace("-", "")),
+                "end_date_id": int(end_date.replace("-", "")),
+            },
+        )
+
+    def get_date_range_sql(self, view, select, group_by, date_filter, freq=None):
+        # One set-based query over a date range or list of dates, with the
+        # rows summed up per day, week or month in the database.
+        if freq not in DATE_RANGE_PERIODS:
+            raise ValueError(f"Unknown frequency: {freq}")
+        group_by_sql = "".join(f", {column}" for column in group_by)
+        return f"""
         SELECT
-            name,
-            full_address,
-            intro,
-            link,
-            station_map_url
-        FROM bart.dim_station
-        WHERE abbreviation = '{station_abb}'
+            {DATE_RANGE_PERIODS[freq]} AS date{group_by_sql},
+            {select}
+        FROM {view} v
+        JOIN bart.dim_date dd ON 1=1
+            AND v.date_id = dd.date_id
+        WHERE {date_filter}
+        GROUP BY 1{group_by_sql}
+        ORDER BY 1{group_by_sql}
         """
-        return self.sql_to_df(sql)
+
+    @cached
+    def get_ridership_by_hour_by_date_range(
+        self, start_date=None, end_date=None, dates=None, freq=None
+    ):
+        date_filter, params = self.get_date_range_filter(start_date, end_date, dates)
+        sql = self.get_date_range_sql(
+            "bart.fact_ridership_count_by_hour_by_date",
+            "SUM(ridership_total) AS ridership_total",
+            ["hour"],
+            date_filter,
+            freq,
+        )
+        return self.sql_to_df(sql, params)
+
+    @cached
+    def get_ridership_by_station_by_date_range(
+        self, start_date=None, end_date=None, dates=None, freq=None
+    ):
+        date_filter, params = self.get_date_range_filter(start_date, end_date, dates)
+        sql = self.get_date_range_sql(
+            "bart.fact_ridership_by_station_by_date",
+            "SUM(origin_count) AS origin_count, "
+            "SUM(destination_count) AS destination_count",
+            ["abbreviation", "latitude", "longitude"],
+            date_filter,
+            freq,
+        )
+        return self.sql_to_df(sql, params)
+
+    @cached
+    def get_ridership_by_hour_by_station_by_date_range(
+        self, start_date=None, end_date=None, dates=None, freq=None
+    ):
+        date_filter, params = self.get_date_range_filter(start_date, end_date, dates)
+        sql = self.get_date_range_sql(
+            "bart.fact_ridership_by_hour_by_station_by_date",
+            "SUM(origin_ridership_total) AS origin_ridership_total, "
+            "SUM(destination_ridership_total) AS destination_ridership_total",
+            ["abbreviation", "hour"],
+            date_filter,
+            freq,
+        )
+        return self.sql_to_df(sql, params)
+
+    @cached
+    def get_total_ride_count_by_date_range(
+        self, start_date=None, end_date=None, dates=None, freq=None
+    ):
+        date_filter, params = self.get_date_range_filter(start_date, end_date, dates)
+        sql = self.get_date_range_sql(
+            "bart.fact_ridership_count_by_date",
+            "SUM(cnt) AS cnt",
+            [],
+            date_filter,
+            freq,
+        )
+        return self.sql_to_df(sql, params)
@@ -1,32 +1,110 @@
+import io
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 import pandas as pd
 import requests
 from bs4 import BeautifulSoup
-
-from bart_ridership.settings import engine, BART_API_TOKEN
+from lxml import etree, html
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from bart_ridership.db.response_cache import get_response_cache
+from bart_ridership.db.version import bump_data_version
+from bart_ridership.settings import (
+    engine,
+    BART_API_TOKEN,
+    BART_API_URL,
+    BART_WEBSITE_URL,
+    STATION_FETCH_RETRIES,
+    STATION_FETCH_WORKERS,
+)
+
+STATION_MAP_LINK_TEXT = "Station Map (PDF)"
+STATION_MAP_LINK_XPATH = f'//a[contains(string(.), "{STATION_MAP_LINK_TEXT}")]/@href'
+
+
+def find_station_map_url(station_page_content):
+    # The map link is the only thing needed from a station page, so pick it
+    # out directly with XPath and only fall back to BeautifulSoup's more
+    # forgiving full parse when that finds nothing.
+    try:
+        hrefs = html.fromstring(station_page_content).xpath(STATION_MAP_LINK_XPATH)
+    except (etree.ParserError, ValueError):
+        hrefs = []
+    if hrefs:
+        return str(hrefs[0])
+    return find_station_map_url_in_soup(station_page_content)
+
+
+def find_station_map_url_in_soup(station_page_content):
+    soup = BeautifulSoup(station_page_content, "lxml")
+    for link in soup.find_all("a"):
+        if STATION_MAP_LINK_TEXT in link.get_text():
+            return link.get("href")
+    return None
+
+
+def get_session(pool_size=STATION_FETCH_WORKERS, retries=STATION_FETCH_RETRIES):
+    # Keep-alive connections shared by every fetch, retrying connection
+    # errors and transient server errors with exponential backoff.
+    retry = Retry(
+        total=retries,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+    )
+    adapter = HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry
+    )
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
 
 
 class StationInformationParser:
 
-    STATION_URL_BASE = "https://www.bart.gov/stations"
-    BART_STATION_API_BASE = f"http://api.bart.gov/api/stn.aspx?cmd=stninfo&key={BART_API_TOKEN}&json=y&orig="
-
-    def __init__(self, station):
-
-        station_url_response = requests.get(
-            f"{self.STATION_URL_BASE}/{station.lower()}"
+    STATION_URL_BASE = f"{BART_WEBSITE_URL}/stations"
+    BART_STATION_API_URL = f"{BART_API_URL}/api/stn.aspx"
+
+    def __init__(self, station, station_page_content=None, station_api_json=None):
+        # The content is fetched here unless it was already fetched, e.g. by
+        # fetch_station_information.
+        if station_page_content is None or station_api_json is None:
+            with get_session(pool_size=1) as session:
+                station_page_content, station_api_json = self.fetch(
+                    session, get_response_cache(), station
+                )
+        self.station_map_url = find_station_map_url(station_page_content)
+        self.station_api_content = station_api_json["root"]["stations"]["station"]
+
+    @classmethod
+    def fetch(cls, session, cache, station):
+        station_url_response = cache.get(
+            session, f"{cls.STATION_URL_BASE}/{station.lower()}"
         )
-        station_url_content = station_url_response.content
-        self.soup = BeautifulSoup(station_url_content, "lxml")
-        self.all_links = self.soup.find_all("a")
-
-        station_api_response = requests.get(
-            f"{self.BART_STATION_API_BASE}{station.lower()}"
+        station_url_response.raise_for_status()
+        # Read before the next request, so each thread holds one connection
+        station_page_content = station_url_response.content
+        station_api_response = cache.get(
+            session,
+            cls.BART_STATION_API_URL,
+            params={
+                "cmd": "stninfo",
+                "key": BART_API_TOKEN,
+                "json": "y",
+                "orig": station.lower(),
+            },
         )
-        self.station_api_content = station_api_response.json()["root"]["stations"][
-            "station"
-        ]
+        station_api_response.raise_for_status()
+        return station_page_content, station_api_response.json()
+
+    def to_record(self):
+        get_methods = [method for method in dir(self) if "get_" in method]
+        return {
+            "_".join(get_method.split("_")[1:]): getattr(self, get_method)()
+            for get_method in get_methods
+        }
 
     def get_latitude(self):
         return self.station_api_content["gtfs_latitude"]
@@ -111,17 +189,33 @@ class StationInformationParser:
             return south_routes
 
     def get_station_map_url(self):
-        for link in self.all_links:
-            if "Station Map (PDF)" in link.get_text():
-                station_map_url = link.get("href")
-                break
-        return station_map_url
+        return self.station_map_url
+
+
+def fetch_station_information(stations, workers=STATION_FETCH_WORKERS):
+    # Both requests for a station go out on one of a bounded number of
+    # threads, sharing a pool of keep-alive connections and the response
+    # cache. The responses are returned in the order of stations.
+    cache = get_response_cache()
+    with get_session(pool_size=workers) as session:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(
+                executor.map(
+                    lambda station: StationInformationParser.fetch(
+                        session, cache, station
+                    ),
+                    stations,
+                )
+            )
 
 
 def create_dim_station():
     # Basic station information (name and abbreviations)
-    station_abbreviation_url = "https://api.bart.gov/docs/overview/abbrev.aspx"
-    station_abbreviation_df = pd.read_html(station_abbreviation_url)[0]
+    station_abbreviation_url = f"{BART_API_URL}/docs/overview/abbrev.aspx"
+    with get_session(pool_size=1) as session:
+        response = get_response_cache().get(session, station_abbreviation_url)
+        response.raise_for_status()
+    station_abbreviation_df = pd.read_html(io.StringIO(response.text))[0]
     station_abbreviation_df.index += 1
     station_abbreviation_df.columns = ["abbreviation_lower", "name"]
     station_abbreviation_df["abbreviation"] = station_abbreviation_df[
@@ -130,32 +224,119 @@ def create_dim_station():
     station_abbreviation_df = station_abbreviation_df[
         ["abbreviation", "abbreviation_lower", "name"]
     ]
-    station_abbreviation_df["station_parser"] = station_abbreviation_df[
-        "abbreviation_lower"
-    ].apply(StationInformationParser)
-    get_methods = [
-        method for method in dir(StationInformationParser) if "get_" in method
-    ]
-    for get_method in get_methods:
-        column_name = "_".join(get_method.split("_")[1:])
-        station_abbreviation_df[column_name] = station_abbreviation_df[
-            "station_parser"
-        ].apply(lambda x: getattr(x, get_method)())
-
-    station_abbreviation_df.drop(columns=["station_parser"], inplace=True)
-    station_abbreviation_df.to_sql(
-        name="dim_station",
-        schema="bart",
-        if_exists="replace",
-        con=engine,
-        index_label="id",
+    stations = station_abbreviation_df["abbreviation_lower"].tolist()
+    logging.info(f"Fetching information for {len(stations)} stations.")
+    station_contents = fetch_station_information(stations)
+    station_information_df = pd.DataFrame(
+        [
+            StationInformationParser(station, *content).to_record()
+            for station, content in zip(stations, station_contents)
+        ],
+        index=station_abbreviation_df.index,
     )
-    create_index_stmt = (
-        "CREATE INDEX idx_abbreviation_ds ON bart.dim_station (abbreviation);"
+    station_abbreviation_df = pd.concat(
+        [station_abbreviation_df, station_information_df], axis=1
     )
-    logging.info(create_index_stmt)
-    engine.execute(create_index_stmt)
-    logging.info("Created bart.dim_station")
+
+    load_dim_station(station_abbreviation_df)
+
+
+def get_dim_station_setup_sql(columns):
+    # Every column but id is text, as DataFrame.to_sql used to create them.
+    # The unique index replaces the plain idx_abbreviation_ds, and is what
+    # stations are upserted on.
+    column_sql = ",\n            ".join(f"{column} TEXT" for column in columns)
+    return [
+        f"""
+        CREATE TABLE IF NOT EXISTS bart.dim_station (
+            id BIGINT,
+            {column_sql}
+        )
+        """,
+        "DROP INDEX IF EXISTS bart.idx_abbreviation_ds",
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_abbreviation_unique_ds
+        ON bart.dim_station (abbreviation)
+        """,
+        """
+        CREATE TEMPORARY TABLE dim_station_staging
+        (LIKE bart.dim_station, list_position INT)
+        ON COMMIT DROP
+        """,
+    ]
+
+
+def get_dim_station_upsert_sql(columns):
+    # Stations keep the id they were first given, as fact_ridership is keyed
+    # on it. New stations are numbered after the current largest id, in the
+    # order they are listed, and stations that are no longer listed are kept
+    # for the rides that still reference them.
+    column_list = ", ".join(columns)
+    update_sql = ",\n            ".join(
+        f"{column} = EXCLUDED.{column}"
+        for column in columns
+        if column != "abbreviation"
+    )
+    return [
+        """
+        UPDATE dim_station_staging s
+        SET id = ds.id
+        FROM bart.dim_station ds
+        WHERE s.abbreviation = ds.abbreviation
+        """,
+        """
+        WITH new_station AS (
+            SELECT
+                abbreviation,
+                ROW_NUMBER() OVER (ORDER BY list_position) AS n
+            FROM dim_station_staging
+            WHERE id IS NULL
+        )
+        UPDATE dim_station_staging s
+        SET id = (SELECT COALESCE(MAX(id), 0) FROM bart.dim_station) + ns.n
+        FROM new_station ns
+        WHERE s.abbreviation = ns.abbreviation
+        """,
+        f"""
+        INSERT INTO bart.dim_station (id, {column_list})
+        SELECT id, {column_list}
+        FROM dim_station_staging
+        ON CONFLICT (abbreviation) DO UPDATE SET
+            {update_sql}
+        """,
+    ]
+
+
+def load_dim_station(station_df):
+    # COPY the stations into a staging table and upsert them into
+    # bart.dim_station in one transaction. The table is never dropped, so
+    # the dashboard and the views built on it always see a complete set of
+    # stations.
+    columns = list(station_df.columns)
+    buffer = io.StringIO()
+    station_df.to_csv(buffer, header=False, index_label="list_position")
+    buffer.seek(0)
+
+    conn = engine.raw_connection()
+    try:
+        with conn.cursor() as cur:
+            for sql in get_dim_station_setup_sql(columns):
+                logging.info(sql)
+                cur.execute(sql)
+            copy_cmd = (
+                f"COPY dim_station_staging (list_position, {', '.join(columns)}) "
+                "FROM STDIN WITH CSV"
+            )
+            logging.info(copy_cmd)
+            cur.copy_expert(copy_cmd, buffer)
+            for sql in get_dim_station_upsert_sql(columns):
+                logging.info(sql)
+                cur.execute(sql)
+        conn.commit()
+    finally:
+        conn.close()
+    bump_data_version(engine, "dim_station")
+    logging.info(f"Loaded {len(station_df)} stations into bart.dim_station")
 
 
 def create_bart_schema():
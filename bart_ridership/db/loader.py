@@ -1,25 +1,137 @@
 import argparse
-import gzip
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
-from io import BytesIO
 
 import requests
+from sqlalchemy import text
 
-from bart_ridership.settings import engine, log
+from bart_ridership.db.od_matrix import refresh_od_matrices
+from bart_ridership.db.response_cache import get_response_cache
+from bart_ridership.db.stream import (
+    CHUNK_SIZE,
+    Digest,
+    IterStream,
+    filter_lines,
+    iter_gunzip,
+    map_lines,
+    prefetch,
+    tee,
+)
+from bart_ridership.db.summary import (
+    LEGACY_MATERIALIZED_VIEWS,
+    MATERIALIZED_VIEW_INDEXES,
+    get_drop_sql,
+    refresh_summary_tables,
+)
+from bart_ridership.db.swap import execute_with_lock_retry
+from bart_ridership.db.version import bump_data_version
+from bart_ridership.settings import (
+    engine,
+    log,
+    LOAD_MAINTENANCE_WORK_MEM,
+    LOADER_DB_MAX_OVERFLOW,
+    LOADER_DB_POOL_SIZE,
+    RESPONSE_CACHE_OFFLINE,
+)
+
+# Each year loaded concurrently holds one of the engine's connections for its
+# whole download and COPY
+MAX_LOADER_CONNECTIONS = LOADER_DB_POOL_SIZE + LOADER_DB_MAX_OVERFLOW
+
+FACT_INDEX_NAME = "idx_date_id_origin_station_id_destionation_station_id_fr_{year}"
+
+# Views that only depend on views in an earlier group, so the views within a
+# group can be refreshed at the same time
+MATERIALIZED_VIEW_REFRESH_GROUPS = [
+    ["fact_ridership_by_hour_by_station_by_date"],
+    ["fact_ridership_by_station_by_date", "fact_ridership_count_by_hour_by_date"],
+    ["fact_ridership_count_by_date"],
+]
+
+# How much of the raw rows kept for the source table stay in memory before
+# spilling to disk, see BartRidershipLoader.copy_to_bart_schema
+SPOOL_MAX_SIZE = 64 * 1024 * 1024
+
+
+class RowKeyer:
+    # Turns a raw day,hour,origin,destination,trip_counter row into a
+    # date_id,hour,origin_station_id,destination_station_id,trip_counter one,
+    # the same way transform_to_bart_schema's joins do. date_id is day as
+    # YYYYMMDD, and rows with a station that is not in dim_station are
+    # dropped, like the inner joins drop them.
+
+    def __init__(self, station_ids):
+        self.station_ids = station_ids
+        self.date_ids = {}
+        self.unknown_stations = set()
+        self.dropped = 0
+
+    def __call__(self, line):
+        if not line.strip():
+            return None
+        day, hour, origin, destination, trip_counter = line.rstrip(b"\r").split(b",")
+        origin_station_id = self.station_ids.get(origin)
+        destination_station_id = self.station_ids.get(destination)
+        if origin_station_id is None or destination_station_id is None:
+            self.dropped += 1
+            for station in (origin, destination):
+                if station not in self.station_ids:
+                    self.unknown_stations.add(station.decode())
+            return None
+        date_id = self.date_ids.get(day)
+        if date_id is None:
+            date_id = self.date_ids[day] = day.replace(b"-", b"")
+        return b",".join(
+            (date_id, hour, origin_station_id, destination_station_id, trip_counter)
+        )
 
 
 class BartRidershipLoader:
 
     BASE_URL = "http://64.111.127.166/origin-destination"
 
-    def __init__(self, start_year, end_year):
+    REFRESH_MODES = ["full", "incremental", "concurrent"]
+
+    PIPELINES = ["staged", "direct"]
+
+    def __init__(
+        self,
+        start_year,
+        end_year,
+        stream=True,
+        workers=1,
+        refresh_mode="full",
+        force=False,
+        offline=False,
+        pipeline="staged",
+        keep_source=False,
+        attach=True,
+    ):
+        if workers > MAX_LOADER_CONNECTIONS:
+            raise ValueError(
+                f"Can't load {workers} years concurrently on a pool of "
+                f"{MAX_LOADER_CONNECTIONS} connections, raise "
+                "LOADER_DB_MAX_OVERFLOW to allow more workers"
+            )
         self.start_year = start_year
         self.end_year = end_year
+        self.stream = stream
+        self.workers = workers
+        self.refresh_mode = refresh_mode
+        self.force = force
+        self.pipeline = pipeline
+        self.keep_source = keep_source
+        self.attach = attach
+        self.station_ids = None
+        self.response_cache = get_response_cache(
+            offline=offline or RESPONSE_CACHE_OFFLINE
+        )
 
-    def get_source_schema_setup_sql(self, year):
+    def get_parent_table_setup_sql(self):
         # Extract source data
         create_schema_sql = "CREATE SCHEMA IF NOT EXISTS source"
-        create_table_sql = """
+        create_source_table_sql = """
         CREATE TABLE IF NOT EXISTS source.ridership (
             day DATE,
             hour INT,
@@ -28,22 +140,7 @@ class BartRidershipLoader:
             trip_counter INT
         ) PARTITION BY RANGE (day);
         """
-        create_year_partition = f"""
-        CREATE TABLE IF NOT EXISTS source.ridership_{year} PARTITION OF source.ridership
-        FOR VALUES FROM ('{year}-01-01') TO ('{int(year) + 1}-01-01');
-        """
-        truncate_partition = f"""
-        TRUNCATE source.ridership_{year}
-        """
-        return [
-            create_schema_sql,
-            create_table_sql,
-            create_year_partition,
-            truncate_partition,
-        ]
-
-    def get_bart_schema_setup_sql(self, year):
-        create_table_sql = """
+        create_fact_table_sql = """
         CREATE TABLE IF NOT EXISTS bart.fact_ridership (
             date_id INT,
             hour INT,
@@ -52,209 +149,632 @@ class BartRidershipLoader:
             trip_counter INT
         ) PARTITION BY RANGE (date_id);
         """
+        return [
+            create_schema_sql,
+            create_source_table_sql,
+            create_fact_table_sql,
+            self.get_fetch_metadata_setup_sql(),
+        ]
+
+    def get_fetch_metadata_setup_sql(self):
+        # What was fetched for each year on the last successful load, used to
+        # tell whether the upstream file changed since.
+        return """
+        CREATE TABLE IF NOT EXISTS source.fetch_metadata (
+            year INT PRIMARY KEY,
+            etag TEXT,
+            last_modified TEXT,
+            content_length BIGINT,
+            content_sha256 CHAR(64),
+            data_length BIGINT,
+            data_sha256 CHAR(64),
+            last_day DATE,
+            fetched_at TIMESTAMP NOT NULL DEFAULT NOW()
+        );
+        """
+
+    def get_partition_bounds(self, parent, year):
+        # The partition key and the range of values a year partition holds
+        if parent == "source.ridership":
+            return "day", f"'{year}-01-01'", f"'{int(year) + 1}-01-01'"
+        return "date_id", f"{year}0101", f"{int(year) + 1}0101"
+
+    def get_staging_table(self, parent, year, since_day=None):
+        # Full reloads go into a detached staging table, which is swapped in
+        # for the year's partition once it is complete, see swap_partitions.
+        # Appends only replace the last few days, in place.
+        if self.attach and since_day is None:
+            return f"{parent}_{year}_staging"
+        return f"{parent}_{year}"
+
+    def get_staging_setup_sql(self, parent, year):
+        staging_table = self.get_staging_table(parent, year)
+        return [
+            f"DROP TABLE IF EXISTS {staging_table}",
+            f"CREATE TABLE {staging_table} (LIKE {parent})",
+        ]
+
+    def get_staging_bounds_sql(self, parent, year):
+        # Matches the partition bounds, so ATTACH PARTITION can skip scanning
+        # the table to validate them
+        column, lower, upper = self.get_partition_bounds(parent, year)
+        name = parent.split(".")[1]
+        return f"""
+        ALTER TABLE {self.get_staging_table(parent, year)}
+        ADD CONSTRAINT {name}_{year}_staging_bounds CHECK (
+            {column} IS NOT NULL
+            AND {column} >= {lower}
+            AND {column} < {upper}
+        )
+        """
+
+    def get_swap_sql(self, parent, year):
+        column, lower, upper = self.get_partition_bounds(parent, year)
+        name = parent.split(".")[1]
+        sql_stmts = [
+            f"DROP TABLE IF EXISTS {parent}_{year}",
+            f"ALTER TABLE {parent}_{year}_staging RENAME TO {name}_{year}",
+        ]
+        if parent == "bart.fact_ridership":
+            sql_stmts.append(f"""
+                ALTER INDEX bart.idx_fr_{year}_staging
+                RENAME TO {FACT_INDEX_NAME.format(year=year)}
+                """)
+        sql_stmts += [
+            f"""
+            ALTER TABLE {parent} ATTACH PARTITION {parent}_{year}
+            FOR VALUES FROM ({lower}) TO ({upper})
+            """,
+            f"""
+            ALTER TABLE {parent}_{year}
+            DROP CONSTRAINT {name}_{year}_staging_bounds
+            """,
+        ]
+        return sql_stmts
+
+    def get_source_schema_setup_sql(self, year, since_day=None):
+        if self.attach and since_day is None:
+            return self.get_staging_setup_sql("source.ridership", year)
+        create_year_partition = f"""
+        CREATE TABLE IF NOT EXISTS source.ridership_{year} PARTITION OF source.ridership
+        FOR VALUES FROM ('{year}-01-01') TO ('{int(year) + 1}-01-01');
+        """
+        if since_day is None:
+            clear_partition = f"""
+            TRUNCATE source.ridership_{year}
+            """
+        else:
+            clear_partition = f"""
+            DELETE FROM source.ridership_{year} WHERE day >= '{since_day}'
+            """
+        return [
+            create_year_partition,
+            clear_partition,
+        ]
+
+    def get_bart_schema_setup_sql(self, year, since_day=None):
+        if self.attach and since_day is None:
+            return self.get_staging_setup_sql("bart.fact_ridership", year)
         create_year_partition = f"""
         CREATE TABLE IF NOT EXISTS bart.fact_ridership_{year} PARTITION OF bart.fact_ridership
         FOR VALUES FROM ('{year}0101') TO ('{int(year) + 1}0101');
         """
+        if since_day is None:
+            # Full loads go into a partition without the index, which is
+            # built once the rows are in rather than maintained row by row.
+            return [
+                create_year_partition,
+                f"DROP INDEX IF EXISTS bart.{FACT_INDEX_NAME.format(year=year)}",
+                f"TRUNCATE bart.fact_ridership_{year}",
+            ]
         create_index_sql = f"""
-        CREATE INDEX IF NOT EXISTS
-        idx_date_id_origin_station_id_destionation_station_id_fr_{year}
+        CREATE INDEX IF NOT EXISTS {FACT_INDEX_NAME.format(year=year)}
         ON bart.fact_ridership_{year} (date_id, origin_station_id, destination_station_id);
         """
-        truncate_partition = f"""
-        TRUNCATE bart.fact_ridership_{year}
+        clear_partition = f"""
+        DELETE FROM bart.fact_ridership_{year}
+        WHERE date_id >= {since_day.strftime("%Y%m%d")}
         """
         return [
-            create_table_sql,
             create_year_partition,
             create_index_sql,
-            truncate_partition,
+            clear_partition,
+        ]
+
+    def get_bart_schema_index_sql(self, year, since_day=None):
+        # Run after a full load, in the same transaction
+        if since_day is not None:
+            return []
+        fact_table = self.get_staging_table("bart.fact_ridership", year)
+        index_name = FACT_INDEX_NAME.format(year=year)
+        if self.attach:
+            index_name = f"idx_fr_{year}_staging"
+        sql_stmts = [
+            f"SET LOCAL maintenance_work_mem = '{LOAD_MAINTENANCE_WORK_MEM}'",
+            f"""
+            CREATE INDEX {index_name}
+            ON {fact_table} (date_id, origin_station_id, destination_station_id);
+            """,
+            f"ANALYZE {fact_table}",
         ]
+        if self.attach:
+            sql_stmts.append(self.get_staging_bounds_sql("bart.fact_ridership", year))
+        return sql_stmts
+
+    def swap_partitions(self, year, since_day=None):
+        # Swap the fully loaded staging tables in for the year's partitions in
+        # one short transaction, so readers go straight from the old rows to
+        # the new ones.
+        if not self.attach or since_day is not None:
+            return
+        parents = ["bart.fact_ridership"]
+        if self.pipeline == "staged" or self.keep_source:
+            parents.insert(0, "source.ridership")
+        sql_stmts = []
+        for parent in parents:
+            sql_stmts += self.get_swap_sql(parent, year)
+        execute_with_lock_retry(sql_stmts, f"swap in the {year} partitions")
+        log.info(f"Swapped in the reloaded {year} partitions.")
+
+    def get_fetch_metadata(self, year):
+        sql = f"""
+        SELECT
+            etag,
+            last_modified,
+            content_sha256,
+            data_length,
+            data_sha256,
+            last_day
+        FROM source.fetch_metadata
+        WHERE year = {year}
+        """
+        row = engine.execute(sql).fetchone()
+        return dict(zip(row.keys(), row)) if row else None
+
+    def save_fetch_metadata(self, year, metadata):
+        sql = """
+        INSERT INTO source.fetch_metadata (
+            year,
+            etag,
+            last_modified,
+            content_length,
+            content_sha256,
+            data_length,
+            data_sha256,
+            last_day
+        )
+        VALUES (
+            :year,
+            :etag,
+            :last_modified,
+            :content_length,
+            :content_sha256,
+            :data_length,
+            :data_sha256,
+            :last_day
+        )
+        ON CONFLICT (year) DO UPDATE SET
+            etag = EXCLUDED.etag,
+            last_modified = EXCLUDED.last_modified,
+            content_length = EXCLUDED.content_length,
+            content_sha256 = EXCLUDED.content_sha256,
+            data_length = EXCLUDED.data_length,
+            data_sha256 = EXCLUDED.data_sha256,
+            last_day = EXCLUDED.last_day,
+            fetched_at = NOW()
+        """
+        engine.execute(text(sql), year=year, **metadata)
 
     def load_to_source_schema(self, year):
+        previous = None if self.force else self.get_fetch_metadata(year)
+        loaded = self.fetch_to_source_schema(year, previous)
+        if loaded["status"] == "rewritten":
+            log.info(f"Upstream {year} file was rewritten, reloading the whole year.")
+            loaded = self.fetch_to_source_schema(year, None)
+        return loaded
+
+    def fetch_to_source_schema(self, year, previous=None):
+        # Download the yearly file and COPY it into its source partition.
+        # Without previous fetch metadata the partition is reloaded from
+        # scratch. With it, the request is conditional, and when the file has
+        # only grown, just the rows from the previously last day on are
+        # replaced. Returns the outcome along with the new fetch metadata.
         file = f"date-hour-soo-dest-{year}.csv.gz"
+        headers = {}
+        since_day = None
+        if previous is not None:
+            since_day = previous["last_day"]
+            if previous["etag"]:
+                headers["If-None-Match"] = previous["etag"]
+            if previous["last_modified"]:
+                headers["If-Modified-Since"] = previous["last_modified"]
+
         conn = engine.raw_connection()
-        response = requests.get(f"{self.BASE_URL}/{file}")
-        content = response.content
-        with conn.cursor() as cur:
-            for sql in self.get_source_schema_setup_sql(year):
-                log.info(sql)
-                cur.execute(sql)
-            with gzip.GzipFile(fileobj=BytesIO(content), mode="rb") as f:
-                copy_cmd = "COPY source.ridership FROM STDIN WITH CSV DELIMITER ','"
-                log.info(copy_cmd)
-                cur.copy_expert(copy_cmd, f)
-            cur.execute("COMMIT")
-        conn.close()
-
-    def transform_to_bart_schema(self, year):
-        for sql in self.get_bart_schema_setup_sql(year):
+        try:
+            with requests.Session() as session, self.response_cache.get(
+                session, f"{self.BASE_URL}/{file}", headers=headers
+            ) as response:
+                if response.status_code == 304:
+                    log.info(f"{file} has not changed since it was last loaded.")
+                    return {"status": "unchanged"}
+                response.raise_for_status()
+
+                # Without streaming the whole file is downloaded up front, and
+                # then goes through the same pipeline as a single chunk.
+                if self.stream:
+                    chunks = prefetch(response.iter_content(CHUNK_SIZE))
+                else:
+                    chunks = iter([response.content])
+                content_digest = Digest()
+                data_digest = Digest(
+                    prefix_length=previous["data_length"] if previous else None
+                )
+                rows = data_digest(iter_gunzip(content_digest(chunks)))
+                if since_day is not None:
+                    since = str(since_day).encode()
+                    rows = filter_lines(rows, lambda line: line[:10] >= since)
+
+                with conn.cursor() as cur:
+                    try:
+                        if self.pipeline == "direct":
+                            self.copy_to_bart_schema(cur, year, since_day, rows)
+                        else:
+                            self.copy_to_source_schema(cur, year, since_day, rows)
+                    finally:
+                        if self.stream:
+                            chunks.close()
+
+                    if previous is not None:
+                        if data_digest.hexdigest() == previous["data_sha256"]:
+                            conn.rollback()
+                            log.info(
+                                f"{file} has not changed since it was last loaded."
+                            )
+                            # The server's validators may still have changed,
+                            # and are kept so the next request is conditional
+                            # on them
+                            return {
+                                "status": "unchanged",
+                                "metadata": self.get_response_metadata(
+                                    response,
+                                    content_digest,
+                                    data_digest,
+                                    previous["last_day"],
+                                ),
+                            }
+                        if data_digest.prefix_sha256 != previous["data_sha256"]:
+                            conn.rollback()
+                            return {"status": "rewritten"}
+
+                    if self.pipeline == "direct":
+                        fact_table = self.get_staging_table(
+                            "bart.fact_ridership", year, since_day
+                        )
+                        cur.execute(
+                            "SELECT TO_DATE(MAX(date_id)::TEXT, 'YYYYMMDD') "
+                            f"FROM {fact_table}"
+                        )
+                    else:
+                        source_table = self.get_staging_table(
+                            "source.ridership", year, since_day
+                        )
+                        cur.execute(f"SELECT MAX(day) FROM {source_table}")
+                    last_day = cur.fetchone()[0]
+                    cur.execute("COMMIT")
+        finally:
+            conn.close()
+
+        return {
+            "status": "loaded" if since_day is None else "appended",
+            "since_day": since_day,
+            "metadata": self.get_response_metadata(
+                response, content_digest, data_digest, last_day
+            ),
+        }
+
+    def get_response_metadata(self, response, content_digest, data_digest, last_day):
+        return {
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "content_length": content_digest.length,
+            "content_sha256": content_digest.hexdigest(),
+            "data_length": data_digest.length,
+            "data_sha256": data_digest.hexdigest(),
+            "last_day": last_day,
+        }
+
+    def copy_to_source_schema(self, cur, year, since_day, rows):
+        for sql in self.get_source_schema_setup_sql(year, since_day):
             log.info(sql)
-            engine.execute(sql)
+            cur.execute(sql)
+        source_table = self.get_staging_table("source.ridership", year, since_day)
+        copy_cmd = f"COPY {source_table} FROM STDIN WITH CSV DELIMITER ','"
+        log.info(copy_cmd)
+        cur.copy_expert(copy_cmd, IterStream(rows), size=CHUNK_SIZE)
+        if self.attach and since_day is None:
+            sql = self.get_staging_bounds_sql("source.ridership", year)
+            log.info(sql)
+            cur.execute(sql)
+
+    def copy_to_bart_schema(self, cur, year, since_day, rows):
+        # The direct pipeline: rows are keyed on the way in and COPYed
+        # straight into the fact partition. With keep_source, the raw rows
+        # are spooled to a temporary file as they go by and COPYed into the
+        # source partition afterwards, in the same transaction.
+        spool = None
+        if self.keep_source:
+            spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+            rows = tee(rows, spool)
+        row_keyer = RowKeyer(self.station_ids)
+        for sql in self.get_bart_schema_setup_sql(year, since_day):
+            log.info(sql)
+            cur.execute(sql)
+        fact_table = self.get_staging_table("bart.fact_ridership", year, since_day)
+        copy_cmd = f"COPY {fact_table} FROM STDIN WITH CSV DELIMITER ','"
+        log.info(copy_cmd)
+        cur.copy_expert(
+            copy_cmd, IterStream(map_lines(rows, row_keyer)), size=CHUNK_SIZE
+        )
+        for sql in self.get_bart_schema_index_sql(year, since_day):
+            log.info(sql)
+            cur.execute(sql)
+        if row_keyer.dropped:
+            log.warning(
+                f"Dropped {row_keyer.dropped} {year} rows with unknown stations "
+                f"{sorted(row_keyer.unknown_stations)}."
+            )
+        if spool is not None:
+            with spool:
+                spool.seek(0)
+                raw_rows = iter(lambda: spool.read(CHUNK_SIZE), b"")
+                self.copy_to_source_schema(cur, year, since_day, raw_rows)
+
+    def get_station_ids(self):
+        sql = "SELECT abbreviation, id FROM bart.dim_station"
+        return {
+            abbreviation.encode(): str(station_id).encode()
+            for abbreviation, station_id in engine.execute(sql)
+        }
+
+    def transform_to_bart_schema(self, year, since_day=None):
+        start_day = f"{year}-01-01" if since_day is None else since_day
         transform_sql = f"""
-        INSERT INTO bart.fact_ridership
+        INSERT INTO {self.get_staging_table("bart.fact_ridership", year, since_day)}
         SELECT
             dim_date.date_id AS date_id,
             hour,
             origin.id AS origin_station_id,
             destination.id AS destination_station_id,
             trip_counter
-        FROM source.ridership
+        FROM {self.get_staging_table("source.ridership", year, since_day)} ridership
         JOIN bart.dim_date ON 1=1
             AND ridership.day = dim_date.date
         JOIN bart.dim_station origin ON 1=1
             AND ridership.origin = origin.abbreviation
         JOIN bart.dim_station destination ON 1=1
             AND ridership.destination = destination.abbreviation
-        WHERE day BETWEEN '{year}-01-01' AND '{year}-12-31'
+        WHERE day BETWEEN '{start_day}' AND '{year}-12-31'
         """
-        log.info(transform_sql)
-        engine.execute(transform_sql)
+        with engine.begin() as conn:
+            for sql in self.get_bart_schema_setup_sql(year, since_day):
+                log.info(sql)
+                conn.execute(sql)
+            log.info(transform_sql)
+            conn.execute(transform_sql)
+            for sql in self.get_bart_schema_index_sql(year, since_day):
+                log.info(sql)
+                conn.execute(sql)
 
     def create_materialized_views(self):
-        sql_stmts = [
+        # The hourly by-station rollup is the only view that scans the fact
+        # table. Each ride is counted once at its origin and once at its
+        # destination through the LATERAL VALUES, and the coarser views are
+        # derived from the much smaller rollup. The sums are cast back to
+        # BIGINT, as the SUM of a BIGINT is a NUMERIC, so the views have the
+        # same column types as the summary tables.
+        create_sql_stmts = [
             """
-            CREATE MATERIALIZED VIEW IF NOT EXISTS bart.fact_ridership_by_station_by_date_tmp
+            CREATE MATERIALIZED VIEW bart.fact_ridership_by_hour_by_station_by_date_tmp
             AS
             SELECT
-                    date_id,
-                    abbreviation,
-                    latitude,
-                    longitude,
-                    origin_count,
-                    destination_count
-                FROM
-                (
-                    SELECT
-                        fr.date_id,
-                        ds.abbreviation,
-                        ds.latitude,
-                        ds.longitude,
-                        COUNT(1) AS origin_count
-                    FROM bart.fact_ridership fr
-                    JOIN bart.dim_station ds ON 1=1
-                        AND fr.origin_station_id = ds.id
-                    GROUP BY date_id, abbreviation, latitude, longitude
-                ) origin
-                JOIN
-                (
-                    SELECT
-                        fr.date_id,
-                        ds.abbreviation,
-                        ds.latitude,
-                        ds.longitude,
-                        COUNT(1) AS destination_count
-                    FROM bart.fact_ridership fr
-                    JOIN bart.dim_station ds ON 1=1
-                        AND fr.destination_station_id = ds.id
-                    GROUP BY date_id, abbreviation, latitude, longitude
-                ) destination
-            USING (date_id, abbreviation, latitude, longitude)
+                fr.date_id,
+                ds.abbreviation,
+                fr.hour,
+                SUM(trips.origin_trips)::BIGINT AS origin_ridership_total,
+                SUM(trips.destination_trips)::BIGINT AS destination_ridership_total
+            FROM bart.fact_ridership fr
+            CROSS JOIN LATERAL (
+                VALUES
+                    (fr.origin_station_id, fr.trip_counter, 0),
+                    (fr.destination_station_id, 0, fr.trip_counter)
+            ) trips (station_id, origin_trips, destination_trips)
+            JOIN bart.dim_station ds ON 1=1
+                AND trips.station_id = ds.id
+            GROUP BY fr.date_id, ds.abbreviation, fr.hour
             WITH NO DATA;
             """,
             """
-            CREATE MATERIALIZED VIEW IF NOT EXISTS bart.fact_ridership_count_by_date_tmp
+            CREATE MATERIALIZED VIEW bart.fact_ridership_by_station_by_date_tmp
             AS
             SELECT
-                date_id,
-                COUNT(1) AS cnt
-            FROM bart.fact_ridership
-            GROUP BY date_id
+                frbhbsbd.date_id,
+                frbhbsbd.abbreviation,
+                ds.latitude,
+                ds.longitude,
+                SUM(frbhbsbd.origin_ridership_total)::BIGINT AS origin_count,
+                SUM(frbhbsbd.destination_ridership_total)::BIGINT AS destination_count
+            FROM bart.fact_ridership_by_hour_by_station_by_date_tmp frbhbsbd
+            JOIN bart.dim_station ds ON 1=1
+                AND frbhbsbd.abbreviation = ds.abbreviation
+            GROUP BY frbhbsbd.date_id, frbhbsbd.abbreviation, ds.latitude, ds.longitude
             WITH NO DATA;
             """,
             """
-            CREATE MATERIALIZED VIEW IF NOT EXISTS bart.fact_ridership_count_by_hour_by_date_tmp
+            CREATE MATERIALIZED VIEW bart.fact_ridership_count_by_hour_by_date_tmp
             AS
             SELECT
                 date_id,
                 hour,
-                COUNT(1) AS ridership_total
-            FROM bart.fact_ridership fr
+                SUM(origin_ridership_total)::BIGINT AS ridership_total
+            FROM bart.fact_ridership_by_hour_by_station_by_date_tmp
             GROUP BY date_id, hour
             WITH NO DATA;
             """,
             """
-            CREATE MATERIALIZED VIEW IF NOT EXISTS bart.fact_ridership_by_hour_by_origin_station_by_date_tmp
-            AS
-            SELECT
-                date_id,
-                abbreviation,
-                hour,
-                COUNT(1) AS origin_ridership_total
-            FROM bart.fact_ridership fr
-            JOIN bart.dim_station ds ON 1=1
-                AND fr.origin_station_id = ds.id
-            GROUP BY date_id, abbreviation, hour
-            WITH NO DATA;
-            """,
-            """
-            CREATE MATERIALIZED VIEW IF NOT EXISTS bart.fact_ridership_by_hour_by_dest_station_by_date_tmp
-            AS
-            SELECT
-            date_id,
-            abbreviation,
-            hour,
-            COUNT(1) AS destination_ridership_total
-            FROM bart.fact_ridership fr
-            JOIN bart.dim_station ds ON 1 = 1
-                AND fr.destination_station_id = ds.id
-            GROUP BY date_id, abbreviation, hour
-            WITH NO DATA;
-            """,
-            """
-            CREATE MATERIALIZED VIEW IF NOT EXISTS bart.fact_ridership_by_hour_by_station_by_date_tmp
+            CREATE MATERIALIZED VIEW bart.fact_ridership_count_by_date_tmp
             AS
             SELECT
                 date_id,
-                abbreviation,
-                hour,
-                origin_ridership_total,
-                destination_ridership_total
-            FROM
-            bart.fact_ridership_by_hour_by_origin_station_by_date_tmp
-            JOIN
-            bart.fact_ridership_by_hour_by_dest_station_by_date_tmp
-            USING(date_id, abbreviation, hour)
+                SUM(ridership_total)::BIGINT AS cnt
+            FROM bart.fact_ridership_count_by_hour_by_date_tmp
+            GROUP BY date_id
             WITH NO DATA;
             """,
-            """CREATE INDEX IF NOT EXISTS idx_date_id_abbreviation_frbhbsbd
-            ON bart.fact_ridership_by_hour_by_station_by_date_tmp (date_id, abbreviation);""",
-            """CREATE INDEX IF NOT EXISTS idx_date_id_frcbhbd
-            ON bart.fact_ridership_count_by_hour_by_date_tmp (date_id);""",
-            """CREATE INDEX IF NOT EXISTS idx_date_id_abbreviation_frbsbd
-            ON bart.fact_ridership_by_station_by_date_tmp (date_id, abbreviation);""",
-            "CREATE INDEX IF NOT EXISTS idx_date_frcbd_tmp ON bart.fact_ridership_count_by_date (date_id);",
-            # Do swap-drop
-            "REFRESH MATERIALIZED VIEW bart.fact_ridership_by_station_by_date_tmp",
-            "DROP MATERIALIZED VIEW IF EXISTS bart.fact_ridership_by_station_by_date",
-            """ALTER MATERIALIZED VIEW bart.fact_ridership_by_station_by_date_tmp
-            RENAME TO fact_ridership_by_station_by_date""",
-            "REFRESH MATERIALIZED VIEW bart.fact_ridership_count_by_date_tmp",
-            "DROP MATERIALIZED VIEW IF EXISTS bart.fact_ridership_count_by_date",
-            """ALTER MATERIALIZED VIEW bart.fact_ridership_count_by_date_tmp
-            RENAME TO fact_ridership_count_by_date""",
-            "REFRESH MATERIALIZED VIEW bart.fact_ridership_count_by_hour_by_date_tmp",
-            "DROP MATERIALIZED VIEW IF EXISTS bart.fact_ridership_count_by_hour_by_date",
-            """ALTER MATERIALIZED VIEW bart.fact_ridership_count_by_hour_by_date_tmp
-            RENAME TO fact_ridership_count_by_hour_by_date""",
-            "REFRESH MATERIALIZED VIEW bart.fact_ridership_by_hour_by_origin_station_by_date_tmp",
-            "REFRESH MATERIALIZED VIEW bart.fact_ridership_by_hour_by_dest_station_by_date_tmp",
-            "REFRESH MATERIALIZED VIEW bart.fact_ridership_by_hour_by_station_by_date_tmp",
-            "DROP MATERIALIZED VIEW IF EXISTS bart.fact_ridership_by_hour_by_station_by_date",
-            """ALTER MATERIALIZED VIEW bart.fact_ridership_by_hour_by_station_by_date_tmp
-            RENAME TO fact_ridership_by_hour_by_station_by_date""",
         ]
-        for sql_stmt in sql_stmts:
+        for view, columns, index in MATERIALIZED_VIEW_INDEXES:
+            create_sql_stmts.append(
+                f"CREATE UNIQUE INDEX {index}_tmp ON bart.{view}_tmp ({columns})"
+            )
+        for view, _, _ in MATERIALIZED_VIEW_INDEXES:
+            create_sql_stmts.append(f"REFRESH MATERIALIZED VIEW bart.{view}_tmp")
+
+        with engine.begin() as conn:
+            # Leftovers of a run that failed before its swap
+            for view, _, _ in reversed(MATERIALIZED_VIEW_INDEXES):
+                sql_stmt = f"DROP MATERIALIZED VIEW IF EXISTS bart.{view}_tmp"
+                log.info(f"Running {sql_stmt}")
+                conn.execute(sql_stmt)
+        for sql_stmt in create_sql_stmts:
             log.info(f"Running {sql_stmt}")
             engine.execute(sql_stmt)
+
+        # Swap the refreshed views in, dependents first, in one transaction,
+        # so the dashboard keeps reading the old aggregates until then. What
+        # they replace is dropped along the way, be it the old views, the
+        # per-origin and per-destination views the rollup replaced, or the
+        # summary tables of incremental mode.
+        with engine.connect() as conn:
+            swap_sql_stmts = get_drop_sql(
+                conn,
+                [view for view, _, _ in reversed(MATERIALIZED_VIEW_INDEXES)]
+                + LEGACY_MATERIALIZED_VIEWS,
+            )
+        for view, _, index in MATERIALIZED_VIEW_INDEXES:
+            swap_sql_stmts += [
+                f"ALTER MATERIALIZED VIEW bart.{view}_tmp RENAME TO {view}",
+                f"ALTER INDEX bart.{index}_tmp RENAME TO {index}",
+            ]
+        execute_with_lock_retry(swap_sql_stmts, "swap in the materialized views")
         log.info("Refreshed all materialized views.")
 
+    def materialized_views_refreshable(self):
+        # Whether every view is there with its unique index, which views
+        # built before the indexes were unique, or replaced by summary
+        # tables, are not.
+        index_names = ", ".join(
+            f"'{index}'" for _, _, index in MATERIALIZED_VIEW_INDEXES
+        )
+        sql = f"""
+        SELECT COUNT(1)
+        FROM pg_index i
+        JOIN pg_class c ON 1=1
+            AND i.indexrelid = c.oid
+        JOIN pg_namespace n ON 1=1
+            AND c.relnamespace = n.oid
+        WHERE n.nspname = 'bart'
+            AND i.indisunique
+            AND c.relname IN ({index_names})
+        """
+        return engine.execute(sql).scalar() == len(MATERIALIZED_VIEW_INDEXES)
+
+    def refresh_materialized_views_concurrently(self):
+        # REFRESH ... CONCURRENTLY never locks readers out of a view, each
+        # view is refreshed on its own connection, and views that do not
+        # depend on each other are refreshed at the same time.
+        if not self.materialized_views_refreshable():
+            log.info("Materialized views are missing their unique indexes.")
+            self.create_materialized_views()
+            return
+        for views in MATERIALIZED_VIEW_REFRESH_GROUPS:
+            with ThreadPoolExecutor(max_workers=len(views)) as executor:
+                futures = [
+                    executor.submit(
+                        execute_with_lock_retry,
+                        [f"REFRESH MATERIALIZED VIEW CONCURRENTLY bart.{view}"],
+                        f"refresh bart.{view}",
+                    )
+                    for view in views
+                ]
+                for future in futures:
+                    future.result()
+        log.info("Refreshed all materialized views concurrently.")
+
+    def refresh_aggregates(self, date_ranges):
+        if self.refresh_mode == "incremental":
+            refresh_summary_tables(date_ranges)
+        elif self.refresh_mode == "concurrent":
+            self.refresh_materialized_views_concurrently()
+        else:
+            self.create_materialized_views()
+        refresh_od_matrices(date_ranges)
+        # Let the dashboard know that its cached query results are stale
+        bump_data_version(engine)
+
+    def load_year(self, year):
+        # Returns the (start, end) date_id range that changed, or None when
+        # the upstream file had not changed and nothing was loaded.
+        log.info(f"Loading {year} bart data into the data warehouse...")
+        loaded = self.load_to_source_schema(year)
+        if loaded["status"] == "unchanged":
+            if "metadata" in loaded:
+                self.save_fetch_metadata(year, loaded["metadata"])
+            log.info(f"Skipping {year}, bart data is already up to date.")
+            return None
+        since_day = loaded["since_day"]
+        if self.pipeline == "staged":
+            self.transform_to_bart_schema(year, since_day)
+        self.swap_partitions(year, since_day)
+        self.save_fetch_metadata(year, loaded["metadata"])
+        log.info(f"Loaded {year} bart data into the data warehouse.")
+        start_date_id = (
+            f"{year}0101" if since_day is None else since_day.strftime("%Y%m%d")
+        )
+        return (start_date_id, f"{year}1231")
+
     def run(self):
-        for year in range(self.start_year, self.end_year + 1):
-            log.info(f"Loading {year} bart data into the data warehouse...")
-            self.load_to_source_schema(year)
-            self.transform_to_bart_schema(year)
-        self.create_materialized_views()
+        # Parent tables are created up front so that concurrent workers only
+        # ever touch their own year's partitions.
+        for sql in self.get_parent_table_setup_sql():
+            log.info(sql)
+            engine.execute(sql)
+        if self.pipeline == "direct":
+            self.station_ids = self.get_station_ids()
+
+        years = list(range(self.start_year, self.end_year + 1))
+        date_ranges = []
+        failed_years = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(self.load_year, year): year for year in years}
+            for future in as_completed(futures):
+                year = futures[future]
+                try:
+                    date_range = future.result()
+                except Exception as error:
+                    log.exception(f"Failed to load {year} bart data: {error}")
+                    failed_years[year] = error
+                else:
+                    if date_range is not None:
+                        date_ranges.append(date_range)
+
+        if date_ranges:
+            self.refresh_aggregates(sorted(date_ranges))
+        else:
+            log.info("No bart data changed, skipping the aggregate refresh.")
+        if failed_years:
+            raise RuntimeError(
+                f"Failed to load bart data for {sorted(failed_years)}, "
+                "see the log above for details."
+            )
 
     def drop_all():
         drop_sql_stmts = [
@@ -282,10 +802,93 @@ if __name__ == "__main__":
         default=datetime.today().year,
         required=False,
     )
+    parser.add_argument(
+        "--buffered",
+        help="Download each yearly file into memory before loading it, instead of "
+        "streaming it into the database",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        help="Number of years to load concurrently, each on its own connection, "
+        "at most LOADER_DB_POOL_SIZE + LOADER_DB_MAX_OVERFLOW",
+        type=int,
+        default=1,
+        required=False,
+    )
+    parser.add_argument(
+        "-r",
+        "--refresh_mode",
+        help="How to refresh the aggregates read by the dashboard: 'full' rebuilds "
+        "the materialized views over all years and swaps them in, 'concurrent' "
+        "refreshes them in place with REFRESH MATERIALIZED VIEW CONCURRENTLY, "
+        "'incremental' only recomputes the summary table partitions of the years "
+        "just loaded",
+        choices=BartRidershipLoader.REFRESH_MODES,
+        default="full",
+        required=False,
+    )
+
+    parser.add_argument(
+        "-f",
+        "--force",
+        help="Reload every year from scratch, even if its upstream file has not changed",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--offline",
+        help="Load the yearly files from the response cache only, without going "
+        "to the network",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "-p",
+        "--pipeline",
+        help="How to get the raw rows into bart.fact_ridership: 'staged' COPYs them "
+        "into source.ridership and transforms them from there in SQL, 'direct' "
+        "looks up the station ids while streaming and COPYs the keyed rows "
+        "straight into the fact table",
+        choices=BartRidershipLoader.PIPELINES,
+        default="staged",
+        required=False,
+    )
+    parser.add_argument(
+        "--keep_source",
+        help="With the direct pipeline, still load the raw rows into "
+        "source.ridership, for auditing",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--in_place",
+        help="Truncate and fully reload each year's partitions in place, instead "
+        "of loading detached staging tables and swapping them in at the end, "
+        "which keeps readers on the old partitions until the new ones are "
+        "complete",
+        action="store_true",
+    )
 
     args = parser.parse_args()
+    if args.workers > MAX_LOADER_CONNECTIONS:
+        parser.error(
+            f"--workers can be at most {MAX_LOADER_CONNECTIONS}, the size of the "
+            "loader's connection pool, see LOADER_DB_MAX_OVERFLOW"
+        )
     start_year = int(args.start_year)
     end_year = int(args.end_year)
 
-    loader = BartRidershipLoader(start_year, end_year)
+    loader = BartRidershipLoader(
+        start_year,
+        end_year,
+        stream=not args.buffered,
+        workers=args.workers,
+        refresh_mode=args.refresh_mode,
+        force=args.force,
+        offline=args.offline,
+        pipeline=args.pipeline,
+        keep_source=args.keep_source,
+        attach=not args.in_place,
+    )
     loader.run()
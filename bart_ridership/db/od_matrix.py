@@ -0,0 +1,116 @@
+import zlib
+
+import numpy as np
+
+from bart_ridership.db.summary import get_fact_years, get_relkind
+from bart_ridership.settings import engine, log
+
+# One row per day, holding that day's trips between every pair of stations
+# for every hour, as a zlib-compressed (hour, origin, destination) array of
+# little-endian int32. Station ids start at 1, so trips from station id i to
+# station id j at hour h are at [h, i - 1, j - 1]. station_count is the
+# largest station id when the day was built.
+OD_MATRIX_SETUP_SQL = """
+CREATE TABLE IF NOT EXISTS bart.od_matrix (
+    date_id INT PRIMARY KEY,
+    station_count INT NOT NULL,
+    matrix BYTEA NOT NULL
+);
+"""
+
+HOURS = 24
+OD_MATRIX_DTYPE = np.dtype("<i4")
+
+
+def encode_od_matrix(matrix):
+    return zlib.compress(matrix.astype(OD_MATRIX_DTYPE).tobytes())
+
+
+def decode_od_matrix(blob, station_count):
+    matrix = np.frombuffer(zlib.decompress(bytes(blob)), dtype=OD_MATRIX_DTYPE)
+    return matrix.reshape(HOURS, station_count, station_count)
+
+
+def top_od_pairs(matrix, n=10):
+    # The n busiest (origin index, destination index, trips) pairs of a
+    # (origin, destination) matrix, busiest first
+    flat = matrix.ravel()
+    n = min(n, flat.size)
+    top = np.argpartition(flat, -n)[-n:]
+    top = top[np.argsort(flat[top])[::-1]]
+    origins, destinations = np.unravel_index(top, matrix.shape)
+    return list(zip(origins.tolist(), destinations.tolist(), flat[top].tolist()))
+
+
+def station_flows(matrix):
+    # Trips out of and into each station of a (origin, destination) matrix
+    return matrix.sum(axis=1), matrix.sum(axis=0)
+
+
+def build_od_matrices(conn, start_date_id, end_date_id, fetch_size=100000):
+    # Replace the matrices of every day in the range, reading the fact rows
+    # ordered by day so only one day's matrix is ever held in memory. conn
+    # is a raw DBAPI connection, committed by the caller.
+    with conn.cursor() as cur:
+        cur.execute("SELECT COALESCE(MAX(id), 0) FROM bart.dim_station")
+        station_count = cur.fetchone()[0]
+        cur.execute(
+            "DELETE FROM bart.od_matrix WHERE date_id BETWEEN %s AND %s",
+            (start_date_id, end_date_id),
+        )
+
+    def save(date_id, matrix):
+        with conn.cursor() as cur:
+            cur.execute(
+                "INSERT INTO bart.od_matrix VALUES (%s, %s, %s)",
+                (date_id, station_count, encode_od_matrix(matrix)),
+            )
+
+    shape = (HOURS, station_count, station_count)
+    date_id, matrix, days = None, None, 0
+    with conn.cursor(name="od_matrix_rows") as rows_cur:
+        rows_cur.itersize = fetch_size
+        rows_cur.execute(
+            """
+            SELECT
+                date_id,
+                hour,
+                origin_station_id,
+                destination_station_id,
+                SUM(trip_counter)
+            FROM bart.fact_ridership
+            WHERE date_id BETWEEN %s AND %s
+            GROUP BY date_id, hour, origin_station_id, destination_station_id
+            ORDER BY date_id
+            """,
+            (start_date_id, end_date_id),
+        )
+        for row_date_id, hour, origin, destination, trips in rows_cur:
+            if row_date_id != date_id:
+                if matrix is not None:
+                    save(date_id, matrix)
+                    days += 1
+                date_id, matrix = row_date_id, np.zeros(shape, OD_MATRIX_DTYPE)
+            matrix[hour, origin - 1, destination - 1] = trips
+    if matrix is not None:
+        save(date_id, matrix)
+        days += 1
+    log.info(f"Built {days} OD matrices from {start_date_id} to {end_date_id}.")
+
+
+def refresh_od_matrices(date_ranges):
+    # The first run creates the table and builds every loaded year, later
+    # runs only rebuild the (start, end) date_id ranges that changed.
+    with engine.begin() as conn:
+        if get_relkind(conn, "od_matrix") is None:
+            date_ranges = [
+                (f"{year}0101", f"{year}1231") for year in get_fact_years(conn)
+            ]
+            conn.execute(OD_MATRIX_SETUP_SQL)
+    for start_date_id, end_date_id in date_ranges:
+        conn = engine.raw_connection()
+        try:
+            build_od_matrices(conn, int(start_date_id), int(end_date_id))
+            conn.commit()
+        finally:
+            conn.close()
@@ -0,0 +1,87 @@
+import pandas as pd
+import psycopg2
+
+from bart_ridership.settings import log
+
+# SQLSTATEs of a prepared statement that is gone, e.g. after the session was
+# reset, and of one whose plan no longer fits, e.g. after a view it reads
+# was rebuilt with different columns
+INVALID_SQL_STATEMENT_NAME = "26000"
+FEATURE_NOT_SUPPORTED = "0A000"
+
+
+class PreparedQuery:
+    # A query with typed $1, $2, ... parameters, prepared on the server once
+    # per pooled connection and then run with EXECUTE, so it skips parsing
+    # and planning after the first call. Which statements a connection has
+    # prepared is tracked in its info dict, which lives as long as the DBAPI
+    # connection does.
+
+    def __init__(self, name, sql, param_types=()):
+        self.name = name
+        self.sql = sql
+        self.param_types = list(param_types)
+
+    def get_prepare_sql(self):
+        types = f" ({', '.join(self.param_types)})" if self.param_types else ""
+        return f"PREPARE {self.name}{types} AS {self.sql}"
+
+    def get_execute_sql(self):
+        if not self.param_types:
+            return f"EXECUTE {self.name}"
+        placeholders = ", ".join("%s" for _ in self.param_types)
+        return f"EXECUTE {self.name} ({placeholders})"
+
+    def _execute(self, conn, params):
+        prepared = conn.info.setdefault("prepared_statements", set())
+        with conn.cursor() as cur:
+            if self.name not in prepared:
+                cur.execute(self.get_prepare_sql())
+                prepared.add(self.name)
+            cur.execute(self.get_execute_sql(), params)
+            columns = [column[0] for column in cur.description]
+            return columns, cur.fetchall()
+
+    def execute(self, engine, *params):
+        # Returns the column names and the rows
+        conn = engine.raw_connection()
+        try:
+            try:
+                result = self._execute(conn, params)
+            except psycopg2.Error as error:
+                if error.pgcode not in (
+                    INVALID_SQL_STATEMENT_NAME,
+                    FEATURE_NOT_SUPPORTED,
+                ):
+                    raise
+                log.info(f"Preparing {self.name} again: {error.pgerror}")
+                conn.rollback()
+                conn.info["prepared_statements"].discard(self.name)
+                if error.pgcode == FEATURE_NOT_SUPPORTED:
+                    with conn.cursor() as cur:
+                        cur.execute(f"DEALLOCATE {self.name}")
+                result = self._execute(conn, params)
+            conn.rollback()
+            return result
+        finally:
+            conn.close()
+
+    def to_df(self, engine, *params):
+        columns, rows = self.execute(engine, *params)
+        return pd.DataFrame.from_records(rows, columns=columns)
+
+    # Lean alternatives to to_df for small results, read straight off the
+    # cursor without building a DataFrame
+
+    def fetch_scalar(self, engine, *params):
+        _, rows = self.execute(engine, *params)
+        return rows[0][0] if rows else None
+
+    def fetch_row(self, engine, *params):
+        columns, rows = self.execute(engine, *params)
+        return dict(zip(columns, rows[0])) if rows else None
+
+    def fetch_columns(self, engine, *params):
+        columns, rows = self.execute(engine, *params)
+        values = zip(*rows) if rows else [() for _ in columns]
+        return {column: list(value) for column, value in zip(columns, values)}
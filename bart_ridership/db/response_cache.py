@@ -0,0 +1,289 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+from bart_ridership.db.stream import CHUNK_SIZE
+from bart_ridership.settings import (
+    log,
+    RESPONSE_CACHE_DIR,
+    RESPONSE_CACHE_MAX_AGE,
+    RESPONSE_CACHE_MAX_BYTES,
+    RESPONSE_CACHE_OFFLINE,
+)
+
+# Response headers kept along with a cached body
+CACHED_HEADERS = ["Content-Type", "ETag", "Last-Modified"]
+
+# Query parameters that are secrets rather than part of what is fetched
+SECRET_PARAMS = ["key"]
+
+
+def get_cache_url(url):
+    # The URL without its API key, which is what entries are stored, looked
+    # up and logged under, so the key never ends up on disk or in the logs
+    parts = urlsplit(url)
+    query = [
+        (name, value)
+        for name, value in parse_qsl(parts.query, keep_blank_values=True)
+        if name not in SECRET_PARAMS
+    ]
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+
+class OfflineCacheMiss(Exception):
+    pass
+
+
+class CachedResponse:
+    # The parts of requests.Response that init_db and the loader use, for a
+    # response that is either read from the cache or streamed from the network
+    # into it.
+
+    def __init__(self, url, status_code, headers, chunks=None, encoding=None):
+        self.url = url
+        self.status_code = status_code
+        self.headers = CaseInsensitiveDict(headers)
+        self.encoding = encoding
+        self._chunks = chunks
+        self._content = None
+
+    def iter_content(self, chunk_size=CHUNK_SIZE):
+        if self._content is not None:
+            return iter([self._content])
+        if self._chunks is None:
+            return iter([])
+        return self._chunks(chunk_size)
+
+    @property
+    def content(self):
+        if self._content is None:
+            self._content = b"".join(self.iter_content())
+        return self._content
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding or "utf-8", errors="replace")
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(
+                f"{self.status_code} Error for url: {self.url}", response=self
+            )
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ResponseCache:
+    # Raw response bodies in a local directory, shared by init_db and the
+    # loader. Bodies are stored once under objects/, named by their SHA-256,
+    # and each URL has an entry under urls/ pointing at its body along with
+    # its ETag and Last-Modified validators.
+    #
+    # Entries younger than max_age are served without going to the network.
+    # Older ones are revalidated with a conditional request, and the body is
+    # only downloaded again when it changed. In offline mode every entry is
+    # served as is and a missing one raises OfflineCacheMiss. Once the bodies
+    # add up to more than max_bytes, the least recently used are evicted.
+
+    def __init__(self, directory, max_bytes, max_age=3600, offline=False):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.offline = offline
+        self.objects_directory = os.path.join(directory, "objects")
+        self.urls_directory = os.path.join(directory, "urls")
+        os.makedirs(self.objects_directory, exist_ok=True)
+        os.makedirs(self.urls_directory, exist_ok=True)
+
+    def _entry_path(self, url):
+        digest = hashlib.sha256(url.encode()).hexdigest()
+        return os.path.join(self.urls_directory, f"{digest}.json")
+
+    def _object_path(self, sha256):
+        return os.path.join(self.objects_directory, sha256)
+
+    def lookup(self, url):
+        try:
+            with open(self._entry_path(url)) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not os.path.exists(self._object_path(entry["sha256"])):
+            return None
+        return entry
+
+    def _save_entry(self, entry):
+        fd, tmp_path = tempfile.mkstemp(dir=self.urls_directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, self._entry_path(entry["url"]))
+
+    def _is_fresh(self, entry):
+        return time.time() - entry["fetched_at"] < self.max_age
+
+    def _get_validators(self, entry):
+        headers = {}
+        if entry["headers"].get("ETag"):
+            headers["If-None-Match"] = entry["headers"]["ETag"]
+        if entry["headers"].get("Last-Modified"):
+            headers["If-Modified-Since"] = entry["headers"]["Last-Modified"]
+        return headers
+
+    def _matches(self, entry, headers):
+        # Whether the caller's conditional request is satisfied by the entry
+        validators = self._get_validators(entry)
+        return any(
+            validators.get(header) == headers[header]
+            for header in ("If-None-Match", "If-Modified-Since")
+            if header in headers
+        )
+
+    def get(self, session, url, params=None, headers=None):
+        url = requests.Request("GET", url, params=params).prepare().url
+        cache_url = get_cache_url(url)
+        headers = dict(headers or {})
+        conditional = "If-None-Match" in headers or "If-Modified-Since" in headers
+        entry = self.lookup(cache_url)
+
+        if entry is not None and (self.offline or self._is_fresh(entry)):
+            if conditional and self._matches(entry, headers):
+                return CachedResponse(cache_url, 304, entry["headers"])
+            return self._open(entry)
+        if self.offline:
+            raise OfflineCacheMiss(f"{cache_url} is not in the response cache")
+
+        if entry is not None and not conditional:
+            headers.update(self._get_validators(entry))
+        response = session.get(url, headers=headers, stream=True)
+        if response.status_code == 304:
+            response.close()
+            if entry is not None and (not conditional or self._matches(entry, headers)):
+                entry["fetched_at"] = time.time()
+                self._save_entry(entry)
+                if not conditional:
+                    return self._open(entry)
+            return CachedResponse(cache_url, 304, response.headers)
+        if response.status_code != 200:
+            content = response.content
+            response.close()
+            return CachedResponse(
+                cache_url,
+                response.status_code,
+                response.headers,
+                lambda chunk_size: iter([content]),
+                response.encoding,
+            )
+        return CachedResponse(
+            cache_url,
+            200,
+            response.headers,
+            lambda chunk_size: self._store(cache_url, response, chunk_size),
+            response.encoding,
+        )
+
+    def _open(self, entry):
+        def read(chunk_size):
+            path = self._object_path(entry["sha256"])
+            sha256 = hashlib.sha256()
+            # Reading marks the body as recently used
+            os.utime(path)
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(chunk_size), b""):
+                    sha256.update(chunk)
+                    yield chunk
+            if sha256.hexdigest() != entry["sha256"]:
+                os.remove(path)
+                raise IOError(f"Cached response for {entry['url']} is corrupt")
+
+        log.info(f"Using cached response for {entry['url']}.")
+        return CachedResponse(
+            entry["url"], 200, entry["headers"], read, entry["encoding"]
+        )
+
+    def _store(self, url, response, chunk_size):
+        # Tee the body into the cache as the caller reads it. It is only
+        # added once it was read to the end.
+        fd, tmp_path = tempfile.mkstemp(dir=self.objects_directory, suffix=".tmp")
+        sha256 = hashlib.sha256()
+        size = 0
+        complete = False
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in response.iter_content(chunk_size):
+                    f.write(chunk)
+                    sha256.update(chunk)
+                    size += len(chunk)
+                    yield chunk
+            complete = True
+        finally:
+            response.close()
+            if complete:
+                os.replace(tmp_path, self._object_path(sha256.hexdigest()))
+                self._save_entry(
+                    {
+                        "url": url,
+                        "sha256": sha256.hexdigest(),
+                        "size": size,
+                        "headers": {
+                            header: response.headers[header]
+                            for header in CACHED_HEADERS
+                            if header in response.headers
+                        },
+                        "encoding": response.encoding,
+                        "fetched_at": time.time(),
+                    }
+                )
+                self.evict()
+            else:
+                os.remove(tmp_path)
+
+    def evict(self):
+        objects = []
+        with os.scandir(self.objects_directory) as entries:
+            for entry in entries:
+                if entry.name.endswith(".tmp"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                objects.append((stat.st_mtime, stat.st_size, entry.path))
+        objects.sort()
+        total_bytes = sum(size for _, size, _ in objects)
+        for _, size, path in objects:
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total_bytes -= size
+            log.info(f"Evicted {os.path.basename(path)} from the response cache.")
+
+
+def get_response_cache(
+    directory=RESPONSE_CACHE_DIR,
+    max_bytes=RESPONSE_CACHE_MAX_BYTES,
+    max_age=RESPONSE_CACHE_MAX_AGE,
+    offline=RESPONSE_CACHE_OFFLINE,
+):
+    directory = directory or os.path.join(
+        tempfile.gettempdir(), "bart-ridership-responses"
+    )
+    return ResponseCache(directory, max_bytes, max_age=max_age, offline=offline)
@@ -0,0 +1,78 @@
+import threading
+import time
+
+from bart_ridership.db.version import get_data_version
+from bart_ridership.settings import log
+
+STATIONS_SQL = "SELECT * FROM bart.dim_station ORDER BY id"
+
+_UNLOADED = object()
+
+
+class StationRegistry:
+    # bart.dim_station held in memory, indexed by abbreviation and by id. It
+    # is loaded with a single query on first use and reloaded only when
+    # init_db bumped the dim_station data version, which is checked at most
+    # every version_check_interval seconds, so lookups almost never touch the
+    # database. Stations are dicts of their dim_station columns.
+
+    def __init__(self, connection, version_check_interval=30):
+        self.connection = connection
+        self.version_check_interval = version_check_interval
+        self._stations_by_abbreviation = {}
+        self._stations_by_id = {}
+        self._version = _UNLOADED
+        self._version_checked_at = None
+        self._lock = threading.Lock()
+
+    def load(self, version=None):
+        stations = [dict(row) for row in self.connection.execute(STATIONS_SQL)]
+        # Swapped in as a whole, so readers never see a partial registry
+        self._stations_by_abbreviation, self._stations_by_id = (
+            {station["abbreviation"]: station for station in stations},
+            {station["id"]: station for station in stations},
+        )
+        self._version = version
+        log.info(f"Loaded {len(stations)} stations (version {version}).")
+
+    def _refresh(self):
+        now = time.monotonic()
+        if (
+            self._version_checked_at is not None
+            and now - self._version_checked_at < self.version_check_interval
+        ):
+            return
+        with self._lock:
+            if (
+                self._version_checked_at is not None
+                and now - self._version_checked_at < self.version_check_interval
+            ):
+                return
+            try:
+                version = get_data_version(self.connection, "dim_station")
+                if version != self._version:
+                    self.load(version)
+            except Exception as error:
+                # Keep serving the stations already loaded until the next
+                # check rather than going to the database on every lookup
+                if self._version is _UNLOADED:
+                    raise
+                log.warning(f"Could not refresh the stations: {error}")
+            self._version_checked_at = now
+
+    def get(self, abbreviation):
+        self._refresh()
+        return self._stations_by_abbreviation.get(abbreviation)
+
+    def get_by_id(self, station_id):
+        self._refresh()
+        return self._stations_by_id.get(station_id)
+
+    def all(self):
+        # Every station, in id order
+        self._refresh()
+        return list(self._stations_by_id.values())
+
+    def __len__(self):
+        self._refresh()
+        return len(self._stations_by_id)
@@ -0,0 +1,174 @@
+import hashlib
+import io
+import queue
+import threading
+import zlib
+
+CHUNK_SIZE = 64 * 1024
+# 16 + MAX_WBITS tells zlib to expect a gzip header and trailer
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+class _Failure:
+    def __init__(self, error):
+        self.error = error
+
+
+_DONE = object()
+
+
+def prefetch(chunks, max_chunks=16):
+    # Pull chunks on a background thread so that producing them (e.g. the
+    # HTTP download) overlaps with consuming them (e.g. the COPY). The queue
+    # is bounded, so at most max_chunks are ever held in memory.
+    buffer = queue.Queue(maxsize=max_chunks)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for chunk in chunks:
+                if not put(chunk):
+                    return
+        except Exception as error:
+            put(_Failure(error))
+            return
+        put(_DONE)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = buffer.get()
+            if item is _DONE:
+                break
+            if isinstance(item, _Failure):
+                raise item.error
+            yield item
+    finally:
+        stop.set()
+        producer.join()
+
+
+def iter_gunzip(chunks, max_length=CHUNK_SIZE):
+    # Incrementally decompress a gzip stream. max_length caps how much output
+    # a single compressed chunk can expand to at once, and concatenated gzip
+    # members are handled the same way gzip.GzipFile handles them.
+    decompressor = zlib.decompressobj(GZIP_WBITS)
+    started = False
+    for chunk in chunks:
+        while chunk:
+            started = True
+            data = decompressor.decompress(chunk, max_length)
+            if data:
+                yield data
+            if decompressor.eof:
+                chunk = decompressor.unused_data
+                decompressor = zlib.decompressobj(GZIP_WBITS)
+                started = False
+            else:
+                chunk = decompressor.unconsumed_tail
+    data = decompressor.flush()
+    if data:
+        yield data
+    if started and not decompressor.eof:
+        raise EOFError(
+            "Compressed file ended before the end-of-stream marker was reached"
+        )
+
+
+def filter_lines(chunks, predicate):
+    # Re-chunk a stream of bytes into whole lines and only pass on the lines
+    # for which predicate(line) is true.
+    pending = b""
+    for chunk in chunks:
+        lines = (pending + chunk).split(b"\n")
+        pending = lines.pop()
+        kept = [line for line in lines if predicate(line)]
+        if kept:
+            yield b"\n".join(kept) + b"\n"
+    if pending and predicate(pending):
+        yield pending
+
+
+def map_lines(chunks, func):
+    # Like filter_lines, but passes on func(line) for every line, leaving out
+    # the lines for which it returns None.
+    pending = b""
+    for chunk in chunks:
+        lines = (pending + chunk).split(b"\n")
+        pending = lines.pop()
+        mapped = [line for line in map(func, lines) if line is not None]
+        if mapped:
+            yield b"\n".join(mapped) + b"\n"
+    if pending:
+        line = func(pending)
+        if line is not None:
+            yield line + b"\n"
+
+
+def tee(chunks, file):
+    # Pass chunks on while writing a copy of them to file
+    for chunk in chunks:
+        file.write(chunk)
+        yield chunk
+
+
+class Digest:
+    # Pass-through that hashes and counts the bytes flowing through it. When
+    # prefix_length is set, the hash of just the first prefix_length bytes is
+    # kept as well, which tells whether a stream only grew at the end.
+
+    def __init__(self, prefix_length=None):
+        self.length = 0
+        self.prefix_length = prefix_length
+        self.prefix_sha256 = None
+        self._sha256 = hashlib.sha256()
+
+    def __call__(self, chunks):
+        for chunk in chunks:
+            cut = None
+            if self.prefix_length is not None and self.prefix_sha256 is None:
+                cut = self.prefix_length - self.length
+            if cut is not None and cut <= len(chunk):
+                self._sha256.update(chunk[:cut])
+                self.prefix_sha256 = self._sha256.hexdigest()
+                self._sha256.update(chunk[cut:])
+            else:
+                self._sha256.update(chunk)
+            self.length += len(chunk)
+            yield chunk
+
+    def hexdigest(self):
+        return self._sha256.hexdigest()
+
+
+class IterStream(io.RawIOBase):
+    # Read-only file object over an iterator of bytes chunks, which is what
+    # cursor.copy_expert expects to read from.
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buffer:
+            try:
+                self._buffer = next(self._chunks)
+            except StopIteration:
+                return 0
+        size = min(len(b), len(self._buffer))
+        b[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
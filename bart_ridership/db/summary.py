@@ -0,0 +1,277 @@
+from bart_ridership.db.swap import execute_with_lock_retry
+from bart_ridership.settings import engine, log
+
+# Partitioned summary tables that stand in for the materialized views built by
+# BartRidershipLoader.create_materialized_views. They keep the same names and
+# columns so the dashboard can read from either, but are maintained one year
+# partition at a time instead of being rebuilt over the whole fact history.
+# The selects read the other summary tables with the given suffix.
+SUMMARY_TABLES = {
+    # Refreshed first, as the only one read from the fact table. Each ride
+    # is counted once at its origin and once at its destination through the
+    # LATERAL VALUES, in a single scan of the range.
+    "fact_ridership_by_hour_by_station_by_date": {
+        "columns": """
+            date_id INT,
+            abbreviation TEXT,
+            hour INT,
+            origin_ridership_total BIGINT,
+            destination_ridership_total BIGINT,
+            PRIMARY KEY (date_id, abbreviation, hour)
+        """,
+        "select": """
+        SELECT
+            fr.date_id,
+            ds.abbreviation,
+            fr.hour,
+            SUM(trips.origin_trips) AS origin_ridership_total,
+            SUM(trips.destination_trips) AS destination_ridership_total
+        FROM bart.fact_ridership fr
+        CROSS JOIN LATERAL (
+            VALUES
+                (fr.origin_station_id, fr.trip_counter, 0),
+                (fr.destination_station_id, 0, fr.trip_counter)
+        ) trips (station_id, origin_trips, destination_trips)
+        JOIN bart.dim_station ds ON 1=1
+            AND trips.station_id = ds.id
+        WHERE fr.date_id BETWEEN {start_date_id} AND {end_date_id}
+        GROUP BY fr.date_id, ds.abbreviation, fr.hour
+        """,
+    },
+    "fact_ridership_by_station_by_date": {
+        "columns": """
+            date_id INT,
+            abbreviation TEXT,
+            latitude TEXT,
+            longitude TEXT,
+            origin_count BIGINT,
+            destination_count BIGINT,
+            PRIMARY KEY (date_id, abbreviation)
+        """,
+        "select": """
+        SELECT
+            frbhbsbd.date_id,
+            frbhbsbd.abbreviation,
+            ds.latitude,
+            ds.longitude,
+            SUM(frbhbsbd.origin_ridership_total) AS origin_count,
+            SUM(frbhbsbd.destination_ridership_total) AS destination_count
+        FROM bart.fact_ridership_by_hour_by_station_by_date{suffix} frbhbsbd
+        JOIN bart.dim_station ds ON 1=1
+            AND frbhbsbd.abbreviation = ds.abbreviation
+        WHERE frbhbsbd.date_id BETWEEN {start_date_id} AND {end_date_id}
+        GROUP BY frbhbsbd.date_id, frbhbsbd.abbreviation, ds.latitude, ds.longitude
+        """,
+    },
+    "fact_ridership_count_by_hour_by_date": {
+        "columns": """
+            date_id INT,
+            hour INT,
+            ridership_total BIGINT,
+            PRIMARY KEY (date_id, hour)
+        """,
+        "select": """
+        SELECT
+            date_id,
+            hour,
+            SUM(origin_ridership_total) AS ridership_total
+        FROM bart.fact_ridership_by_hour_by_station_by_date{suffix}
+        WHERE date_id BETWEEN {start_date_id} AND {end_date_id}
+        GROUP BY date_id, hour
+        """,
+    },
+    "fact_ridership_count_by_date": {
+        "columns": """
+            date_id INT,
+            cnt BIGINT,
+            PRIMARY KEY (date_id)
+        """,
+        "select": """
+        SELECT
+            date_id,
+            SUM(ridership_total) AS cnt
+        FROM bart.fact_ridership_count_by_hour_by_date{suffix}
+        WHERE date_id BETWEEN {start_date_id} AND {end_date_id}
+        GROUP BY date_id
+        """,
+    },
+}
+
+# The materialized views read by the dashboard, built by
+# BartRidershipLoader.create_materialized_views in this order, with the
+# columns of their unique index and the index's name. The unique indexes are
+# what REFRESH MATERIALIZED VIEW CONCURRENTLY matches rows on.
+MATERIALIZED_VIEW_INDEXES = [
+    (
+        "fact_ridership_by_hour_by_station_by_date",
+        "date_id, abbreviation, hour",
+        "idx_date_id_abbreviation_hour_frbhbsbd",
+    ),
+    (
+        "fact_ridership_by_station_by_date",
+        "date_id, abbreviation",
+        "idx_date_id_abbreviation_unique_frbsbd",
+    ),
+    (
+        "fact_ridership_count_by_hour_by_date",
+        "date_id, hour",
+        "idx_date_id_hour_frcbhbd",
+    ),
+    ("fact_ridership_count_by_date", "date_id", "idx_date_id_unique_frcbd"),
+]
+
+# Views the hourly by-station rollup used to be built from
+LEGACY_MATERIALIZED_VIEWS = [
+    "fact_ridership_by_hour_by_origin_station_by_date_tmp",
+    "fact_ridership_by_hour_by_dest_station_by_date_tmp",
+]
+
+# Materialized views (including the leftover _tmp ones) that the summary
+# tables replace, dependents first so that each can be dropped without
+# CASCADE.
+MATERIALIZED_VIEWS = [
+    name
+    for view, _, _ in reversed(MATERIALIZED_VIEW_INDEXES)
+    for name in (view, f"{view}_tmp")
+] + LEGACY_MATERIALIZED_VIEWS
+
+
+def get_relkind(conn, name, schema="bart"):
+    sql = f"""
+    SELECT c.relkind
+    FROM pg_class c
+    JOIN pg_namespace n ON 1=1
+        AND c.relnamespace = n.oid
+    WHERE n.nspname = '{schema}'
+        AND c.relname = '{name}'
+    """
+    return conn.execute(sql).scalar()
+
+
+def get_fact_years(conn):
+    sql = """
+    SELECT c.relname
+    FROM pg_inherits i
+    JOIN pg_class c ON 1=1
+        AND i.inhrelid = c.oid
+    WHERE i.inhparent = 'bart.fact_ridership'::regclass
+    """
+    relnames = [row[0] for row in conn.execute(sql)]
+    return sorted(
+        int(relname.split("_")[-1])
+        for relname in relnames
+        if relname.split("_")[-1].isdigit()
+    )
+
+
+# Suffix of the summary tables the first incremental run builds next to the
+# materialized views, until they are swapped in
+NEW_SUFFIX = "_new"
+
+
+def summary_tables_exist(conn):
+    return all(get_relkind(conn, name) == "p" for name in SUMMARY_TABLES)
+
+
+def get_drop_sql(conn, names):
+    # DROP statements for whichever of names exist, as a materialized view or
+    # as a summary table
+    kinds = {"m": "MATERIALIZED VIEW", "p": "TABLE"}
+    sql_stmts = []
+    for name in names:
+        kind = kinds.get(get_relkind(conn, name))
+        if kind is not None:
+            sql_stmts.append(f"DROP {kind} bart.{name}")
+    return sql_stmts
+
+
+def create_summary_tables(conn, suffix=""):
+    for name, table in SUMMARY_TABLES.items():
+        sql = f"""
+        CREATE TABLE IF NOT EXISTS bart.{name}{suffix} ({table["columns"]})
+        PARTITION BY RANGE (date_id);
+        """
+        log.info(sql)
+        conn.execute(sql)
+
+
+def drop_summary_tables(conn, suffix=""):
+    for sql in get_drop_sql(conn, [f"{name}{suffix}" for name in SUMMARY_TABLES]):
+        log.info(sql)
+        conn.execute(sql)
+
+
+def refresh_summary_range(conn, start_date_id, end_date_id, suffix=""):
+    # Ranges never span years, so they always fall in a single partition.
+    year = int(start_date_id) // 10000
+    for name, table in SUMMARY_TABLES.items():
+        table_name = f"{name}{suffix}"
+        sql_stmts = [
+            f"""
+            CREATE TABLE IF NOT EXISTS bart.{table_name}_{year}
+            PARTITION OF bart.{table_name}
+            FOR VALUES FROM ({year}0101) TO ({year + 1}0101);
+            """,
+            f"""
+            DELETE FROM bart.{table_name}
+            WHERE date_id BETWEEN {start_date_id} AND {end_date_id}
+            """,
+            f"INSERT INTO bart.{table_name}"
+            + table["select"].format(
+                start_date_id=start_date_id, end_date_id=end_date_id, suffix=suffix
+            ),
+        ]
+        for sql_stmt in sql_stmts:
+            log.info(f"Running {sql_stmt}")
+            conn.execute(sql_stmt)
+
+
+def get_summary_swap_sql(conn, years):
+    # Drops the materialized views, and renames the new summary tables and
+    # their year partitions into their place
+    sql_stmts = get_drop_sql(conn, MATERIALIZED_VIEWS)
+    for name in SUMMARY_TABLES:
+        new_name = f"{name}{NEW_SUFFIX}"
+        sql_stmts += [
+            f"ALTER TABLE bart.{new_name} RENAME TO {name}",
+            f"ALTER INDEX bart.{new_name}_pkey RENAME TO {name}_pkey",
+        ]
+        sql_stmts += [
+            f"ALTER TABLE bart.{new_name}_{year} RENAME TO {name}_{year}"
+            for year in years
+        ]
+    return sql_stmts
+
+
+def create_and_backfill_summary_tables():
+    # Every loaded year is backfilled into new summary tables, one year per
+    # transaction, while the dashboard keeps reading the materialized views.
+    # Only the swap takes locks on what the dashboard reads.
+    with engine.begin() as conn:
+        drop_summary_tables(conn, NEW_SUFFIX)
+        create_summary_tables(conn, NEW_SUFFIX)
+        years = get_fact_years(conn)
+    for year in years:
+        with engine.begin() as conn:
+            refresh_summary_range(conn, f"{year}0101", f"{year}1231", NEW_SUFFIX)
+    with engine.connect() as conn:
+        swap_sql_stmts = get_summary_swap_sql(conn, years)
+    execute_with_lock_retry(swap_sql_stmts, "swap in the summary tables")
+    log.info("Created and backfilled summary tables.")
+
+
+def refresh_summary_tables(date_ranges):
+    # Each (start, end) date_id range is replaced in its own transaction, so
+    # readers see either the old or the new aggregates for it and never a
+    # partial refresh.
+    with engine.connect() as conn:
+        exist = summary_tables_exist(conn)
+    if not exist:
+        # First incremental run: swap the materialized views out for the
+        # summary tables
+        create_and_backfill_summary_tables()
+        return
+    for start_date_id, end_date_id in date_ranges:
+        with engine.begin() as conn:
+            refresh_summary_range(conn, start_date_id, end_date_id)
+        log.info(f"Refreshed summary tables from {start_date_id} to {end_date_id}.")
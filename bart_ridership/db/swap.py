@@ -0,0 +1,32 @@
+import time
+
+from sqlalchemy.exc import OperationalError
+
+from bart_ridership.settings import engine, log, SWAP_LOCK_TIMEOUT, SWAP_RETRIES
+
+# SQLSTATE of a lock_timeout
+LOCK_NOT_AVAILABLE = "55P03"
+
+
+def execute_with_lock_retry(sql_stmts, description):
+    # Run sql_stmts in one transaction under lock_timeout, so that waiting on
+    # a long-running query never leaves them queued in front of every query
+    # after it. On a lock timeout the transaction is retried after a backoff.
+    for attempt in range(1, SWAP_RETRIES + 1):
+        try:
+            with engine.begin() as conn:
+                conn.execute(f"SET LOCAL lock_timeout = '{SWAP_LOCK_TIMEOUT}'")
+                for sql in sql_stmts:
+                    log.info(f"Running {sql}")
+                    conn.execute(sql)
+            return
+        except OperationalError as error:
+            if getattr(error.orig, "pgcode", None) != LOCK_NOT_AVAILABLE:
+                raise
+            if attempt == SWAP_RETRIES:
+                raise
+            log.warning(
+                f"Could not get the locks to {description} "
+                f"(attempt {attempt} of {SWAP_RETRIES}), retrying."
+            )
+            time.sleep(2**attempt)
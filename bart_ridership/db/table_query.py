@@ -0,0 +1,99 @@
+# Translates the DataTable's custom filter_query and sort_by properties into
+# SQL. Column names are always checked against the caller's whitelist and
+# values are always bound as parameters, never spliced into the SQL.
+import re
+
+# {column} operator value, where operators come either spelled out or as symbols
+FILTER_PART = re.compile(
+    r"^\s*\{(?P<name>[^}]+)\}\s+(?P<operator>\S+)\s+(?P<value>.+?)\s*$"
+)
+OPERATOR_ALIASES = {">=": "ge", "<=": "le", "<": "lt", ">": "gt", "!=": "ne", "=": "eq"}
+
+SQL_OPERATORS = {
+    "ge": ">=",
+    "le": "<=",
+    "lt": "<",
+    "gt": ">",
+    "ne": "<>",
+    "eq": "=",
+}
+
+
+def split_filter_part(filter_part):
+    match = FILTER_PART.match(filter_part)
+    if match is None:
+        return None
+    name = match.group("name")
+    operator = OPERATOR_ALIASES.get(match.group("operator"), match.group("operator"))
+    if operator not in SQL_OPERATORS and operator not in ("contains", "datestartswith"):
+        return None
+    value_part = match.group("value")
+    quote = value_part[0]
+    if len(value_part) > 1 and quote == value_part[-1] and quote in ("'", '"', "`"):
+        value = value_part[1:-1].replace("\\" + quote, quote)
+    else:
+        try:
+            value = float(value_part)
+        except ValueError:
+            value = value_part
+    return name, operator, value
+
+
+def parse_filter_query(filter_query):
+    if not filter_query:
+        return []
+    filters = []
+    for filter_part in filter_query.split(" && "):
+        parsed = split_filter_part(filter_part)
+        if parsed is not None:
+            filters.append(parsed)
+    return filters
+
+
+def _escape_like(value):
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def build_where(filter_query, columns, numeric_columns=()):
+    # Returns the WHERE conditions and their bind parameters. Numeric
+    # comparisons are only used against numeric columns; everything else is
+    # compared as text, the way the native DataTable filter behaves.
+    conditions = []
+    params = {}
+    for i, (name, operator, value) in enumerate(parse_filter_query(filter_query)):
+        if name not in columns:
+            raise ValueError(f"Unknown column in filter: {name}")
+        param = f"filter_{i}"
+        if operator == "contains":
+            conditions.append(f"CAST({name} AS TEXT) ILIKE :{param}")
+            params[param] = f"%{_escape_like(_format(value))}%"
+        elif operator == "datestartswith":
+            conditions.append(f"CAST({name} AS TEXT) LIKE :{param}")
+            params[param] = f"{_escape_like(_format(value))}%"
+        elif name in numeric_columns and isinstance(value, float):
+            conditions.append(f"{name} {SQL_OPERATORS[operator]} :{param}")
+            params[param] = value
+        else:
+            conditions.append(
+                f"CAST({name} AS TEXT) {SQL_OPERATORS[operator]} :{param}"
+            )
+            params[param] = _format(value)
+    return conditions, params
+
+
+def build_order_by(sort_by, columns):
+    order_by = []
+    for sort in sort_by or []:
+        name = sort["column_id"]
+        if name not in columns:
+            raise ValueError(f"Unknown column in sort: {name}")
+        direction = "DESC" if sort.get("direction") == "desc" else "ASC"
+        order_by.append(f"{name} {direction}")
+    return order_by
+
+
+def _format(value):
+    # Filter values typed as whole numbers come back as floats
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
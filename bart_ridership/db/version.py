@@ -0,0 +1,46 @@
+from sqlalchemy.exc import ProgrammingError
+
+from bart_ridership.settings import log
+
+# Stamps bumped whenever a dataset read by the dashboard is republished, so
+# that readers can tell their cached results are stale.
+DATA_VERSION_SETUP_SQL = """
+CREATE TABLE IF NOT EXISTS bart.data_version (
+    name TEXT PRIMARY KEY,
+    version BIGINT NOT NULL,
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+"""
+
+
+def bump_data_version(connection, name="ridership"):
+    bump_sql = f"""
+    INSERT INTO bart.data_version (name, version)
+    VALUES ('{name}', 1)
+    ON CONFLICT (name) DO UPDATE SET
+        version = data_version.version + 1,
+        updated_at = NOW()
+    """
+    connection.execute(DATA_VERSION_SETUP_SQL)
+    connection.execute(bump_sql)
+    log.info(f"Bumped the {name} data version.")
+
+
+def get_data_version(connection, name="ridership"):
+    sql = f"SELECT version FROM bart.data_version WHERE name = '{name}'"
+    try:
+        return connection.execute(sql).scalar()
+    except ProgrammingError:
+        # Nothing has been published since the table was introduced
+        return None
+
+
+def get_data_versions(connection, names=("ridership", "dim_station")):
+    # The versions of several datasets from one query, in the order of names
+    name_list = ", ".join(f"'{name}'" for name in names)
+    sql = f"SELECT name, version FROM bart.data_version WHERE name IN ({name_list})"
+    try:
+        versions = dict(connection.execute(sql).fetchall())
+    except ProgrammingError:
+        versions = {}
+    return tuple(versions.get(name) for name in names)
@@ -25,7 +25,70 @@ DB_SCHEMA = _get_config("POSTGRES_DB")
 DB_URL = f"postgresql://{DB_USER}:{DB_PWD}@{DB_HOST}:{DB_PORT}/{DB_SCHEMA}"
 BART_API_TOKEN = _get_config("BART_API_TOKEN")
 MAPBOX_ACCESS_TOKEN = _get_config("MAPBOX_ACCESS_TOKEN")
-engine = sqlalchemy.create_engine(DB_URL)
+# Pool of the dashboard's engine, small and quick to give up so a callback
+# fails fast instead of queueing
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 5))
+DB_POOL_TIMEOUT = int(os.environ.get("DB_POOL_TIMEOUT", 10))
+# Pool of the engine init_db and the loader use, where every year loaded
+# concurrently holds a connection for its whole download
+LOADER_DB_POOL_SIZE = int(os.environ.get("LOADER_DB_POOL_SIZE", 5))
+LOADER_DB_MAX_OVERFLOW = int(os.environ.get("LOADER_DB_MAX_OVERFLOW", 10))
+LOADER_DB_POOL_TIMEOUT = int(os.environ.get("LOADER_DB_POOL_TIMEOUT", 30))
+DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", 1800))
+DB_POOL_PRE_PING = os.environ.get("DB_POOL_PRE_PING", "true") in ("1", "true")
+# In milliseconds, for every statement the dashboard runs
+DASHBOARD_STATEMENT_TIMEOUT = int(os.environ.get("DASHBOARD_STATEMENT_TIMEOUT", 15000))
+
+
+def _create_engine(pool_size, max_overflow, pool_timeout, **kwargs):
+    return sqlalchemy.create_engine(
+        DB_URL,
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_timeout=pool_timeout,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=DB_POOL_PRE_PING,
+        **kwargs,
+    )
+
+
+engine = _create_engine(
+    LOADER_DB_POOL_SIZE, LOADER_DB_MAX_OVERFLOW, LOADER_DB_POOL_TIMEOUT
+)
+# For the dashboard's queries: read-only sessions whose statements are
+# cancelled after DASHBOARD_STATEMENT_TIMEOUT, so a slow query can't hold on
+# to a pooled connection for long. BartRidershipData.iter_csv lifts the
+# timeout for the CSV exports, which can stream a whole year.
+dashboard_engine = _create_engine(
+    DB_POOL_SIZE,
+    DB_MAX_OVERFLOW,
+    DB_POOL_TIMEOUT,
+    connect_args={
+        "options": "-c default_transaction_read_only=on "
+        f"-c statement_timeout={DASHBOARD_STATEMENT_TIMEOUT}"
+    },
+)
+QUERY_CACHE_BACKEND = os.environ.get("QUERY_CACHE_BACKEND", "file")
+QUERY_CACHE_DIR = os.environ.get("QUERY_CACHE_DIR")
+QUERY_CACHE_REDIS_URL = os.environ.get("QUERY_CACHE_REDIS_URL")
+QUERY_CACHE_MAX_ENTRIES = int(os.environ.get("QUERY_CACHE_MAX_ENTRIES", 512))
+QUERY_CACHE_TTL = int(os.environ.get("QUERY_CACHE_TTL", 3600))
+# Overridable so station metadata can be fetched from a local fixture server,
+# see scripts/station_fixture_server.py
+BART_WEBSITE_URL = os.environ.get("BART_WEBSITE_URL", "https://www.bart.gov")
+BART_API_URL = os.environ.get("BART_API_URL", "https://api.bart.gov")
+STATION_FETCH_WORKERS = int(os.environ.get("STATION_FETCH_WORKERS", 8))
+STATION_FETCH_RETRIES = int(os.environ.get("STATION_FETCH_RETRIES", 3))
+# Memory for building the fact indexes after a bulk load
+LOAD_MAINTENANCE_WORK_MEM = os.environ.get("LOAD_MAINTENANCE_WORK_MEM", "1GB")
+# How long swapping in a reloaded partition waits for locks before retrying
+SWAP_LOCK_TIMEOUT = os.environ.get("SWAP_LOCK_TIMEOUT", "5s")
+SWAP_RETRIES = int(os.environ.get("SWAP_RETRIES", 5))
+RESPONSE_CACHE_DIR = os.environ.get("RESPONSE_CACHE_DIR")
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get("RESPONSE_CACHE_MAX_BYTES", 2 * 1024**3))
+RESPONSE_CACHE_MAX_AGE = int(os.environ.get("RESPONSE_CACHE_MAX_AGE", 3600))
+RESPONSE_CACHE_OFFLINE = os.environ.get("RESPONSE_CACHE_OFFLINE", "") in ("1", "true")
 
 logging.basicConfig(
     level=logging.INFO,
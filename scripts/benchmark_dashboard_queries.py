@@ -0,0 +1,92 @@
+"""Compare the dashboard queries' DataFrame reads with the lean variants.
+
+Runs each query both ways against the configured database, through
+BartRidershipData with the query cache off, and prints the latency per call.
+The date snapshot row compares the lean per-figure reads with the single
+snapshot query the callbacks now make, and the station registry row compares
+the lean station info read with a lookup in the in-memory registry:
+
+PYTHONPATH=. python scripts/benchmark_dashboard_queries.py 2019-06-04 -s 12TH
+"""
+
+import argparse
+import timeit
+
+from bart_ridership.db.data import BartRidershipData
+from bart_ridership.db.stations import StationRegistry
+from bart_ridership.settings import dashboard_engine
+
+
+def get_callbacks(data, stations, date, station_abb):
+    # (name, DataFrame read, lean read) for every query a callback makes,
+    # each doing the little work the callback does with the result
+    def read_date_lean():
+        return [
+            data.get_total_ride_count(date),
+            data.get_ridership_by_hour_by_date_columns(date),
+            data.get_ridership_by_hour_by_station_and_date_columns(date, station_abb),
+            data.get_ridership_by_station_by_date_columns(date),
+        ]
+
+    return [
+        (
+            "total rides",
+            lambda: data.get_total_ride_count_by_day(date)["cnt"][0],
+            lambda: data.get_total_ride_count(date),
+        ),
+        (
+            "station info",
+            lambda: data.get_station_info(station_abb)["name"][0],
+            lambda: data.get_station_info_row(station_abb)["name"],
+        ),
+        (
+            "hourly histogram",
+            lambda: list(data.get_ridership_by_hour_by_date(date)["hour"]),
+            lambda: data.get_ridership_by_hour_by_date_columns(date)["hour"],
+        ),
+        (
+            "station histogram",
+            lambda: list(
+                data.get_ridership_by_hour_by_station_and_date(date, station_abb)[
+                    "hour"
+                ]
+            ),
+            lambda: data.get_ridership_by_hour_by_station_and_date_columns(
+                date, station_abb
+            )["hour"],
+        ),
+        (
+            "map",
+            lambda: list(data.get_ridership_by_station_by_date(date)["latitude"]),
+            lambda: data.get_ridership_by_station_by_date_columns(date)["latitude"],
+        ),
+        ("date snapshot", read_date_lean, lambda: data.get_date_snapshot(date)),
+        (
+            "station registry",
+            lambda: data.get_station_info_row(station_abb)["name"],
+            lambda: stations.get(station_abb)["name"],
+        ),
+    ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("date", help="A loaded date, e.g. 2019-06-04")
+    parser.add_argument("-s", "--station", default="12TH")
+    parser.add_argument("-n", "--number", type=int, default=200)
+    args = parser.parse_args()
+
+    data = BartRidershipData(connection=dashboard_engine)
+    stations = StationRegistry(dashboard_engine)
+    print(f"{'':>17}  {'before':>10}  {'after':>10}")
+    callbacks = get_callbacks(data, stations, args.date, args.station)
+    for name, before, after in callbacks:
+        # Once each first, so both run against prepared statements and a
+        # warm connection pool
+        before()
+        after()
+        timings = [
+            timeit.timeit(read, number=args.number) / args.number * 1000
+            for read in (before, after)
+        ]
+        print(f"{name:>17}: {timings[0]:7.3f} ms  {timings[1]:7.3f} ms")
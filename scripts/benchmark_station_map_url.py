@@ -0,0 +1,54 @@
+"""Compare ways of finding the station map link on saved station pages.
+
+python scripts/station_fixture_server.py record fixtures/ 12th 16th mont
+PYTHONPATH=. python scripts/benchmark_station_map_url.py fixtures/%2Fstations%2F*
+"""
+
+import argparse
+import timeit
+
+from bs4 import BeautifulSoup, SoupStrainer
+
+from bart_ridership.db.init_db import (
+    STATION_MAP_LINK_TEXT,
+    find_station_map_url,
+    find_station_map_url_in_soup,
+)
+
+
+def find_station_map_url_with_strainer(station_page_content):
+    soup = BeautifulSoup(station_page_content, "lxml", parse_only=SoupStrainer("a"))
+    for link in soup.find_all("a"):
+        if STATION_MAP_LINK_TEXT in link.get_text():
+            return link.get("href")
+    return None
+
+
+PARSERS = {
+    "full soup": find_station_map_url_in_soup,
+    "soup strainer": find_station_map_url_with_strainer,
+    "lxml xpath": find_station_map_url,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("pages", nargs="+", help="Saved station pages")
+    parser.add_argument("-n", "--number", type=int, default=20)
+    args = parser.parse_args()
+
+    pages = []
+    for path in args.pages:
+        with open(path, "rb") as f:
+            pages.append(f.read())
+
+    expected = [find_station_map_url_in_soup(page) for page in pages]
+    for name, parse in PARSERS.items():
+        found = [parse(page) for page in pages]
+        if found != expected:
+            print(f"{name} found different links: {found} instead of {expected}")
+        seconds = timeit.timeit(
+            lambda: [parse(page) for page in pages], number=args.number
+        )
+        per_page = seconds / (args.number * len(pages)) * 1000
+        print(f"{name:>15}: {per_page:.3f} ms per page")
@@ -0,0 +1,109 @@
+"""Record and serve the BART pages and API responses used by init_db.
+
+Record the responses for a few stations once:
+
+    python scripts/station_fixture_server.py record fixtures/ 12th 16th mont
+
+and serve them locally, pointing init_db at the server:
+
+    python scripts/station_fixture_server.py serve fixtures/ --port 8000
+    BART_WEBSITE_URL=http://localhost:8000 BART_API_URL=http://localhost:8000 \
+        python -m bart_ridership.db.init_db
+
+--delay adds a fixed latency to every response, which is useful to benchmark
+fetch_station_information against something close to the real round-trips.
+"""
+
+import argparse
+import os
+import time
+from http.server import HTTPServer, SimpleHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qsl, quote, urlencode, urlsplit
+
+import requests
+
+BART_WEBSITE_URL = "https://www.bart.gov"
+BART_API_URL = "https://api.bart.gov"
+
+
+def get_fixture_name(path):
+    # The API key is left out, so fixtures work whatever key is configured
+    url = urlsplit(path)
+    query = [(key, value) for key, value in parse_qsl(url.query) if key != "key"]
+    name = url.path + ("?" + urlencode(sorted(query)) if query else "")
+    return quote(name, safe="")
+
+
+def record(directory, stations, api_token):
+    os.makedirs(directory, exist_ok=True)
+    paths = ["/docs/overview/abbrev.aspx"]
+    for station in stations:
+        paths.append(f"/stations/{station}")
+        paths.append(
+            "/api/stn.aspx?"
+            + urlencode(
+                {"cmd": "stninfo", "key": api_token, "json": "y", "orig": station}
+            )
+        )
+    with requests.Session() as session:
+        for path in paths:
+            base_url = (
+                BART_WEBSITE_URL if path.startswith("/stations") else BART_API_URL
+            )
+            response = session.get(base_url + path)
+            response.raise_for_status()
+            with open(os.path.join(directory, get_fixture_name(path)), "wb") as f:
+                f.write(response.content)
+            print(f"Recorded {path.split('?')[0]}")
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(directory, port, delay):
+    class FixtureHandler(SimpleHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            time.sleep(delay)
+            path = os.path.join(directory, get_fixture_name(self.path))
+            if not os.path.exists(path):
+                self.send_error(404)
+                return
+            with open(path, "rb") as f:
+                content = f.read()
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+    server = ThreadingHTTPServer(("", port), FixtureHandler)
+    print(f"Serving {directory} on port {port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command")
+    # Set after the fact, as add_subparsers only takes required from 3.7 on
+    subparsers.required = True
+    record_parser = subparsers.add_parser("record")
+    record_parser.add_argument("directory")
+    record_parser.add_argument("stations", nargs="+")
+    record_parser.add_argument(
+        "--api_token",
+        default=os.environ.get("BART_API_TOKEN"),
+        required="BART_API_TOKEN" not in os.environ,
+        help="Defaults to $BART_API_TOKEN",
+    )
+    serve_parser = subparsers.add_parser("serve")
+    serve_parser.add_argument("directory")
+    serve_parser.add_argument("-p", "--port", type=int, default=8000)
+    serve_parser.add_argument("-d", "--delay", type=float, default=0)
+    args = parser.parse_args()
+    if args.command == "record":
+        record(args.directory, args.stations, args.api_token)
+    else:
+        serve(args.directory, args.port, args.delay)
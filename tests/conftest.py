@@ -0,0 +1,15 @@
+import os
+
+# settings reads these at import time. None of the tests connect to the
+# database or to SSM.
+for name, value in {
+    "POSTGRES_USER": "bart",
+    "POSTGRES_PASSWORD": "bart",
+    "POSTGRES_HOST": "localhost",
+    "POSTGRES_PORT": "5432",
+    "POSTGRES_DB": "bart",
+    "BART_API_TOKEN": "test",
+    "MAPBOX_ACCESS_TOKEN": "test",
+    "AWS_DEFAULT_REGION": "us-west-2",
+}.items():
+    os.environ.setdefault(name, value)
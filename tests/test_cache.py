@@ -0,0 +1,157 @@
+import os
+import pickle
+import stat
+import threading
+import time
+
+import pytest
+
+from bart_ridership.db.cache import (
+    _MISSING,
+    FileBackend,
+    MemoryBackend,
+    QueryCache,
+    RedisBackend,
+    _digest,
+)
+
+
+def get_or_compute_in_thread(cache, key, compute, timeout=5):
+    # Runs get_or_compute in a thread, so a deadlock fails the test instead
+    # of hanging it
+    result = {}
+    thread = threading.Thread(
+        target=lambda: result.update(value=cache.get_or_compute(key, compute)),
+        daemon=True,
+    )
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), "get_or_compute deadlocked"
+    return result["value"]
+
+
+def test_file_backend_nested_keys_sharing_digest_prefix(tmp_path):
+    cache = QueryCache(FileBackend(str(tmp_path)))
+    outer = ("build_histogram_figure", ("2019-01-01",), ())
+    prefix = _digest((None, outer))[:2]
+    date = next(
+        f"2019-{i:04d}"
+        for i in range(100000)
+        if _digest((None, ("get_date_snapshot", (f"2019-{i:04d}",), ())))[:2] == prefix
+    )
+    inner = ("get_date_snapshot", (date,), ())
+
+    value = get_or_compute_in_thread(
+        cache, outer, lambda: cache.get_or_compute(inner, lambda: "snapshot")
+    )
+
+    assert value == "snapshot"
+    assert cache.get_or_compute(inner, lambda: "recomputed") == "snapshot"
+
+
+def test_memory_backend_evicts_least_recently_used():
+    backend = MemoryBackend(max_entries=2)
+    backend.set("a", 1)
+    backend.set("b", 2)
+    assert backend.get("a") == 1
+    backend.set("c", 3)
+
+    assert backend.get("b") is _MISSING
+    assert backend.get("a") == 1
+    assert backend.get("c") == 3
+    assert backend.evictions == 1
+
+
+def test_memory_backend_expires_entries(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    backend = MemoryBackend(ttl=10)
+    backend.set("a", 1)
+    now[0] += 9
+    assert backend.get("a") == 1
+    now[0] += 1
+    assert backend.get("a") is _MISSING
+
+
+def test_file_backend_round_trip_and_ttl(tmp_path):
+    backend = FileBackend(str(tmp_path), ttl=10)
+    backend.set(("key", 1), {"value": [1, 2]})
+    assert backend.get(("key", 1)) == {"value": [1, 2]}
+    assert backend.get(("key", 2)) is _MISSING
+
+    path = backend._path(("key", 1))
+    os.utime(path, (time.time() - 11, time.time() - 11))
+    assert backend.get(("key", 1)) is _MISSING
+
+
+def test_file_backend_evicts_oldest_and_expired(tmp_path):
+    backend = FileBackend(str(tmp_path), max_entries=2, ttl=100, evict_every=1000)
+    for i, age in enumerate([50, 40, 30, 200]):
+        backend.set(i, i)
+        mtime = time.time() - age
+        os.utime(backend._path(i), (mtime, mtime))
+    backend.evict()
+
+    assert [backend.get(i) for i in range(4)] == [_MISSING, 1, 2, _MISSING]
+    assert backend.evictions == 2
+
+
+def test_file_backend_directory_is_private(tmp_path):
+    directory = tmp_path / "cache"
+    os.umask(0)
+    try:
+        FileBackend(str(directory))
+    finally:
+        os.umask(0o022)
+    assert stat.S_IMODE(os.stat(directory).st_mode) == 0o700
+
+
+def test_file_backend_clears_a_directory_others_could_write(tmp_path):
+    directory = tmp_path / "cache"
+    directory.mkdir()
+    (directory / "planted.pkl").write_bytes(pickle.dumps("planted"))
+    os.chmod(directory, 0o777)
+
+    FileBackend(str(directory))
+
+    assert stat.S_IMODE(os.stat(directory).st_mode) == 0o700
+    assert not (directory / "planted.pkl").exists()
+
+
+def test_file_backend_refuses_a_directory_of_another_user(tmp_path, monkeypatch):
+    monkeypatch.setattr(os, "getuid", lambda: os.stat(tmp_path).st_uid + 1)
+    with pytest.raises(PermissionError):
+        FileBackend(str(tmp_path / "cache"))
+
+
+class DictRedis:
+    def __init__(self):
+        self.values = {}
+
+    def get(self, name):
+        return self.values.get(name)
+
+    def set(self, name, value, ex=None):
+        self.values[name] = value
+
+
+def test_redis_backend_round_trip():
+    client = DictRedis()
+    backend = RedisBackend(client, prefix="test:")
+    backend.set(("key", 1), [1, 2])
+
+    assert backend.get(("key", 1)) == [1, 2]
+    assert backend.get(("key", 2)) is _MISSING
+    assert all(name.startswith("test:") for name in client.values)
+
+
+def test_query_cache_misses_after_a_version_change():
+    version = [1]
+    cache = QueryCache(version_getter=lambda: version[0], version_check_interval=0)
+    assert cache.get_or_compute("key", lambda: "v1") == "v1"
+    assert cache.get_or_compute("key", lambda: "again") == "v1"
+
+    version[0] = 2
+    assert cache.get_or_compute("key", lambda: "v2") == "v2"
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 2
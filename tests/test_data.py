@@ -0,0 +1,111 @@
+import pandas as pd
+
+from bart_ridership.db import data as data_module
+from bart_ridership.db.data import BartRidershipData
+
+
+def test_default_order_by_hour_without_hour_column():
+    sql, params = BartRidershipData(None).get_ridership_table_sql(
+        "2019-06-04", ["trip_counter", "origin_station"]
+    )
+    inner, outer = sql.rsplit(") ridership", 1)
+
+    assert "AS hour" in inner
+    assert "ORDER BY hour, origin_station, destination_station_id" in outer
+    assert outer.count("hour") == 1
+    assert sql.split("FROM", 1)[0].split() == [
+        "SELECT",
+        "trip_counter,",
+        "origin_station",
+    ]
+
+
+class PagedData(BartRidershipData):
+    # Answers the page query with no rows, as for a page past the last match,
+    # and the count query with 42
+    def __init__(self):
+        super().__init__(None)
+        self.queries = []
+
+    def sql_to_df(self, sql, params=None):
+        self.queries.append(sql)
+        if sql.startswith("SELECT COUNT(*)"):
+            return pd.DataFrame({"total_rows": [42]})
+        return pd.DataFrame({"hour": [], "total_rows": []})
+
+
+def test_ridership_page_past_the_last_match_still_counts_rows():
+    data = PagedData()
+    page_df, total_rows = data.get_ridership_page(
+        "2019-06-04", ["hour"], page_current=3, filter_query="{hour} > 20"
+    )
+
+    assert len(page_df) == 0
+    assert total_rows == 42
+    assert len(data.queries) == 2
+
+
+def test_empty_first_page_is_not_counted_again():
+    data = PagedData()
+    assert data.get_ridership_page("2019-06-04", ["hour"])[1] == 0
+    assert len(data.queries) == 1
+
+
+def test_lean_methods_read_through_the_prepared_queries():
+    calls = []
+
+    class Query:
+        def __init__(self, name):
+            self.name = name
+
+        def __getattr__(self, fetch):
+            return lambda connection, *args: calls.append((self.name, fetch, args))
+
+    data = BartRidershipData(None)
+    names = [
+        "TOTAL_RIDE_COUNT_BY_DAY",
+        "STATION_INFO",
+        "RIDERSHIP_BY_HOUR_BY_DATE",
+        "RIDERSHIP_BY_HOUR_BY_STATION_AND_DATE",
+        "RIDERSHIP_BY_STATION_BY_DATE",
+    ]
+    originals = {name: getattr(data_module, name) for name in names}
+    try:
+        for name in names:
+            setattr(data_module, name, Query(name))
+        data.get_total_ride_count("2019-06-04")
+        data.get_station_info_row("12TH")
+        data.get_ridership_by_hour_by_date_columns("2019-06-04")
+        data.get_ridership_by_hour_by_station_and_date_columns("2019-06-04", "12TH")
+        data.get_ridership_by_station_by_date_columns("2019-06-04")
+    finally:
+        for name, query in originals.items():
+            setattr(data_module, name, query)
+
+    assert calls == [
+        ("TOTAL_RIDE_COUNT_BY_DAY", "fetch_scalar", (20190604,)),
+        ("STATION_INFO", "fetch_row", ("12TH",)),
+        ("RIDERSHIP_BY_HOUR_BY_DATE", "fetch_columns", (20190604,)),
+        ("RIDERSHIP_BY_HOUR_BY_STATION_AND_DATE", "fetch_columns", (20190604, "12TH")),
+        ("RIDERSHIP_BY_STATION_BY_DATE", "fetch_columns", (20190604,)),
+    ]
+
+
+class StationRows:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def execute(self, sql):
+        return self
+
+    def fetchall(self):
+        return self.rows
+
+
+def test_od_matrix_stations_fill_gaps_in_ids():
+    data = BartRidershipData(StationRows([(1, "12TH"), (3, "16TH")]))
+    assert data.get_od_matrix_stations() == ["12TH", None, "16TH"]
+
+
+def test_od_matrix_stations_without_stations():
+    assert BartRidershipData(StationRows([])).get_od_matrix_stations() == []
@@ -0,0 +1,42 @@
+from sqlalchemy.exc import ProgrammingError
+
+from bart_ridership.db.cache import QueryCache
+from bart_ridership.db.version import get_data_versions
+
+
+class VersionRows:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def execute(self, sql):
+        if self.rows is None:
+            raise ProgrammingError(sql, None, Exception("no data_version table"))
+        return self
+
+    def fetchall(self):
+        return list(self.rows.items())
+
+
+def test_data_versions_in_the_order_asked():
+    connection = VersionRows({"dim_station": 4, "ridership": 7})
+    assert get_data_versions(connection) == (7, 4)
+
+
+def test_data_versions_before_anything_was_published():
+    assert get_data_versions(VersionRows({"ridership": 7})) == (7, None)
+    assert get_data_versions(VersionRows(None)) == (None, None)
+
+
+def test_station_reload_invalidates_the_query_cache():
+    connection = VersionRows({"ridership": 7, "dim_station": 1})
+    cache = QueryCache(
+        version_getter=lambda: get_data_versions(connection),
+        version_check_interval=0,
+    )
+    computes = []
+    cache.get_or_compute("stations", lambda: computes.append(1))
+    cache.get_or_compute("stations", lambda: computes.append(1))
+    connection.rows["dim_station"] = 2
+    cache.get_or_compute("stations", lambda: computes.append(1))
+
+    assert len(computes) == 2